@@ -0,0 +1,116 @@
+"""Пакетный прогон уровней без окна в нескольких процессах.
+
+Каждый эпизод — уровень со своим seed врагов и агент со случайным блужданием.
+Результаты эпизодов идут построчно в JSON Lines по мере готовности, в конце — сводка.
+
+Пример:
+    python batch.py --episodes 1000                       # все три уровня
+    python batch.py --levels Hell --episodes 5000 --processes 8 --output hell.jsonl
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from multiprocessing import Pool
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # Иначе приветствие pygame попадёт в поток JSON Lines
+# SDL перехватывает SIGTERM, и Pool.terminate() не смог бы остановить процессы
+os.environ.setdefault("SDL_NO_SIGNAL_HANDLERS", "1")
+
+import pygame
+
+import main
+
+MOVE_KEYS = (pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d)
+OUTCOMES = {True: "victory", False: "defeat", None: "timeout"}
+
+
+def init_worker():
+    """Инициализация процесса: pygame без окна, текстуры загрузятся один раз на процесс"""
+    pygame.init()
+
+
+def random_walk(level, rng, tick, period):
+    """Агент: раз в period шагов отпускает клавиши и выбирает новое направление"""
+    if tick % period:
+        return
+    for key in MOVE_KEYS:
+        level.handle_events(pygame.event.Event(pygame.KEYUP, key=key))
+    level.handle_events(pygame.event.Event(pygame.KEYDOWN, key=rng.choice(MOVE_KEYS)))
+
+
+def run_episode(task):
+    """Один эпизод; возвращает компактный кортеж (уровень, seed, исход, шаги, убийства)"""
+    level_name, seed, max_ticks, period, hunters = task
+    level = main.create_headless_level(level_name, seed=seed, hunters=hunters)
+    rng = random.Random(seed)  # Агент детерминирован вместе с уровнем
+    tick = 0
+    while not level.is_game_over and tick < max_ticks:
+        random_walk(level, rng, tick, period)
+        level.step()
+        tick += 1
+    level.close()
+    return level_name, seed, level.victory, level.clock.ticks, level.kills
+
+
+def tasks(args):
+    """Эпизоды по кругу по уровням, чтобы частичные результаты были по всем уровням"""
+    for episode in range(args.episodes):
+        for level_name in args.levels:
+            yield level_name, args.seed + episode, args.max_ticks, args.period, args.hunters
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Прогон уровней случайным агентом в нескольких процессах")
+    parser.add_argument("--levels", nargs="+", default=list(main.LEVELS), choices=list(main.LEVELS))
+    parser.add_argument("--episodes", type=int, default=100, help="эпизодов на уровень")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="число процессов")
+    parser.add_argument("--max-ticks", type=int, default=main.TICK_RATE * 120, help="предел шагов эпизода")
+    parser.add_argument("--period", type=int, default=30, help="шагов между сменами направления агента")
+    parser.add_argument("--hunters", action="store_true", help="враги идут к игроку по полю направлений")
+    parser.add_argument("--seed", type=int, default=0, help="seed первого эпизода")
+    parser.add_argument("--chunksize", type=int, default=16, help="эпизодов в одной посылке процессу")
+    parser.add_argument("--output", help="файл JSON Lines для эпизодов (по умолчанию stdout)")
+    return parser.parse_args(argv)
+
+
+def batch_main(argv=None):
+    args = parse_args(argv)
+    output = open(args.output, "w") if args.output else sys.stdout
+    summary = {name: {"victory": 0, "defeat": 0, "timeout": 0, "ticks": 0, "kills": 0} for name in args.levels}
+
+    start = time.perf_counter()
+    with Pool(args.processes, initializer=init_worker) as pool:
+        # Порядок не важен: результаты пишем сразу, как только процесс их вернул
+        for level_name, seed, victory, ticks, kills in pool.imap_unordered(run_episode, tasks(args),
+                                                                          args.chunksize):
+            outcome = OUTCOMES[victory]
+            output.write(json.dumps({"level": level_name, "seed": seed, "outcome": outcome,
+                                     "ticks": ticks, "kills": kills}) + "\n")
+            output.flush()  # Эпизоды видны сразу, даже если прогон прервут
+            stats = summary[level_name]
+            stats[outcome] += 1
+            stats["ticks"] += ticks
+            stats["kills"] += kills
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+    if args.output:
+        output.close()
+
+    episodes = args.episodes * len(args.levels)
+    total_ticks = sum(stats["ticks"] for stats in summary.values())
+    report = {"processes": args.processes, "episodes": episodes, "seconds": elapsed,
+              "episodes_per_s": episodes / elapsed, "ticks_per_s": total_ticks / elapsed,
+              "levels": {name: dict(stats, win_rate=stats["victory"] / args.episodes if args.episodes else 0.0)
+                         for name, stats in summary.items()}}
+    print(json.dumps(report, indent=2), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(batch_main())
@@ -0,0 +1,362 @@
+"""Бенчмарк уровней на сгенерированных лабиринтах.
+
+Пример:
+    python bench.py --size 201 --enemies 0.02 --potions 0.005 --ticks 600 --output bench.json
+    python bench.py --size 201 --baseline bench.json
+    python bench.py --streaming                 # плюс проход коридора через границы чанков
+    python bench.py --startup                   # запуск без кэша поверхностей, с холодным и с тёплым
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # Приветствие pygame испортило бы JSON в stdout
+
+import pygame
+
+import main
+
+# Метрики, по которым сравниваемся с сохранённым эталоном (больше — хуже)
+COMPARED_METRICS = ["load_s", "load_map_s", "peak_load_bytes"]
+
+
+def generate_maze(width, height, enemy_density=0.0, potion_density=0.0, seed=0):
+    """Генерирует лабиринт в текстовом формате уровней (0/1/2/@/*/#)"""
+    rng = random.Random(seed)
+    # Лабиринт строится на нечётной сетке, чтобы стены и проходы чередовались
+    width = max(width | 1, 5)
+    height = max(height | 1, 5)
+    grid = [['1'] * width for _ in range(height)]
+
+    # Итеративный поиск в глубину (рекурсия упёрлась бы в лимит на больших картах)
+    stack = [(1, 1)]
+    grid[1][1] = '0'
+    while stack:
+        x, y = stack[-1]
+        neighbours = [(x + dx, y + dy, dx, dy) for dx, dy in ((2, 0), (-2, 0), (0, 2), (0, -2))
+                      if 0 < x + dx < width - 1 and 0 < y + dy < height - 1 and grid[y + dy][x + dx] == '1']
+        if not neighbours:
+            stack.pop()
+            continue
+        nx, ny, dx, dy = rng.choice(neighbours)
+        grid[y + dy // 2][x + dx // 2] = '0'
+        grid[ny][nx] = '0'
+        stack.append((nx, ny))
+
+    # Спавны ставим только в проходы и не вплотную к старту
+    for y in range(1, height - 1):
+        for x in range(1, width - 1):
+            if grid[y][x] != '0' or x + y < 6:
+                continue
+            roll = rng.random()
+            if roll < enemy_density:
+                grid[y][x] = '*'
+            elif roll < enemy_density + potion_density:
+                grid[y][x] = '#'
+
+    grid[1][1] = '@'
+    grid[height - 2][width - 2] = '2'
+    return ["".join(row) for row in grid]
+
+
+def write_maze(lines, directory):
+    """Сохраняет лабиринт во временный файл уровня"""
+    handle, path = tempfile.mkstemp(suffix=".txt", prefix="maze_", dir=directory)
+    with os.fdopen(handle, "w") as file:
+        file.write("\n".join(lines) + "\n")
+    return path
+
+
+def percentiles(samples):
+    """p50/p90/p99/max в миллисекундах"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {"p50_ms": pick(0.5), "p90_ms": pick(0.9), "p99_ms": pick(0.99), "max_ms": ordered[-1] * 1000}
+
+
+def random_walk(level, rng, tick):
+    """Скриптовый игрок: раз в полсекунды меняет направление"""
+    if tick % 30:
+        return
+    for key in (pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d):
+        level.handle_events(pygame.event.Event(pygame.KEYUP, key=key))
+    level.handle_events(pygame.event.Event(pygame.KEYDOWN, key=rng.choice((pygame.K_w, pygame.K_s,
+                                                                          pygame.K_a, pygame.K_d))))
+
+
+def bench_collisions(level, rng, queries=10000):
+    """Время одного запроса к индексу стен, мс"""
+    width = level.walls.width * level.tile_size
+    height = level.walls.height * level.tile_size
+    points = [(rng.randrange(width), rng.randrange(height)) for _ in range(queries)]
+    start = time.perf_counter()
+    for x, y in points:
+        level.walls.overlaps(x, y, x + 39, y + 39)
+    return (time.perf_counter() - start) * 1000 / queries
+
+
+def bench_flow_field(level, rng, samples=50):
+    """Пересчёт поля направлений для случайных клеток игрока: медиана в мс и средний охват"""
+    field = main.FlowField(level.walls)
+    walls = level.walls
+    cells = [(x, y) for x, y in ((rng.randrange(walls.width), rng.randrange(walls.height)) for _ in range(samples * 20))
+             if not walls.is_wall(x, y)][:samples]
+    times, reached = [], []
+    for x, y in cells:
+        start = time.perf_counter()
+        field.update(x, y)
+        times.append(time.perf_counter() - start)
+        reached.append(len(field.steps))
+    return {"max_distance": field.max_distance,
+            "recompute_ms": statistics.median(times) * 1000 if times else 0.0,
+            "cells_reached": statistics.mean(reached) if reached else 0}
+
+
+def bench_field_of_view(level, rng, samples=200):
+    """Видимость из случайных проходов: медиана расчёта без кэша в мс и среднее число клеток"""
+    field = main.FieldOfView(level.walls, cache_size=0)
+    walls = level.walls
+    cells = [(x, y) for x, y in ((rng.randrange(walls.width), rng.randrange(walls.height)) for _ in range(samples * 20))
+             if not walls.is_wall(x, y)][:samples]
+    times, visible = [], []
+    for x, y in cells:
+        start = time.perf_counter()
+        visible.append(len(field.visible(x, y)))
+        times.append(time.perf_counter() - start)
+    result = {"radius": field.radius,
+              "compute_ms": statistics.median(times) * 1000 if times else 0.0,
+              "cells_visible": statistics.mean(visible) if visible else 0}
+    if level.fog is not None:  # Как часто игроку хватило кэша за прогон
+        fov = level.fog.fov
+        result.update(rebuilds=level.fog.rebuilds, cache_hits=fov.hits, cache_misses=fov.misses)
+    return result
+
+
+def bench_movement(level, rng, samples=5000, speeds=(5, 8, 64, 128)):
+    """Шаг игрока по X: прежняя проверка углов в точке назначения против swept-сдвига.
+
+    Для каждой скорости: время шага в мкс, средний недоход до стены при остановке
+    и число пролётов сквозь стену (у проверки углов они возможны на больших скоростях).
+    variable_step — дробные позиции и сдвиг 5 * dt со случайным dt, как при неровном кадре.
+    """
+    walls = level.walls
+    hitbox = level.player.hitbox
+    starts = []
+    while len(starts) < samples:
+        x, y = rng.randrange(walls.width * level.tile_size), rng.randrange(walls.height * level.tile_size)
+        if not walls.overlaps(*hitbox(x, y)):
+            starts.append((x, y))
+
+    cases = [(str(speed), [(x, y, rng.choice((-speed, speed))) for x, y in starts]) for speed in speeds]
+    fractional = [(x + rng.random(), y + rng.random()) for x, y in starts]
+    cases.append(("variable_step", [(x, y, rng.choice((-5, 5)) * rng.uniform(0.5, 1.5)) for x, y in fractional
+                                    if not walls.overlaps(*hitbox(x, y))]))
+
+    result = {}
+    for name, moves in cases:
+        start = time.perf_counter()
+        corner = [0 if walls.overlaps(*hitbox(x + dx, y)) else dx for x, y, dx in moves]
+        corner_s = time.perf_counter() - start
+        start = time.perf_counter()
+        swept = [walls.sweep_x(*hitbox(x, y), dx) for x, y, dx in moves]
+        swept_s = time.perf_counter() - start
+
+        stalls = [abs(exact) for old, exact, (_, _, dx) in zip(corner, swept, moves) if old == 0 and exact != dx]
+        result[name] = {
+            "four_corner_us": corner_s * 1e6 / len(moves),
+            "swept_us": swept_s * 1e6 / len(moves),
+            "four_corner_gap_px": statistics.mean(stalls) if stalls else 0.0,  # У swept недохода нет
+            "four_corner_tunnels": sum(old != 0 and exact != old for old, exact in zip(corner, swept)),
+        }
+    return result
+
+
+def check_streaming_corridor(args, length=150):
+    """Проход по коридору через несколько чанков подкачки до выхода; True — выход достигнут.
+
+    Подкачка на каждом шаге дожидается загрузки, иначе без окна шаги идут быстрее фонового потока.
+    """
+    lines = ["1" * (length + 2), "1@" + "0" * (length - 1) + "21", "1" * (length + 2)]
+    path = write_maze(lines, args.tmpdir)
+    try:
+        level = main.create_headless_level("Desert", path, streaming=True, seed=args.seed)
+    finally:
+        os.remove(path)
+        if os.path.exists(main.compiled_level_path(path)):
+            os.remove(main.compiled_level_path(path))
+    level.handle_events(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_d))
+    for _ in range(length * level.tile_size):  # С запасом: игрок проходит клетку за несколько шагов
+        if level.is_game_over:
+            break
+        level.step()
+        level.map_data.queue.join()
+    level.close()
+    return {"tiles": length, "reached_tile": level.player.x // level.tile_size, "ok": level.victory is True}
+
+
+def run(args):
+    """Прогоняет один сценарий и возвращает метрики"""
+    pygame.init()
+    screen = pygame.display.set_mode((800, 600))
+    rng = random.Random(args.seed)
+
+    lines = generate_maze(args.size, args.height or args.size, args.enemies, args.potions, args.seed)
+    path = write_maze(lines, args.tmpdir)
+    try:
+        if args.streaming:  # Компиляция — отдельный шаг сборки, в загрузку её не включаем
+            main.ensure_compiled_level(path)
+        start = time.perf_counter()
+        main.load_level(path)
+        load_map_s = time.perf_counter() - start
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        textures, _, next_level = main.LEVELS["Desert"]
+        level = main.ShowLevel(screen, textures, path, next_level, None, streaming=args.streaming,
+                               seed=args.seed, hunters=args.hunters, fog=args.fog)
+        load_s = time.perf_counter() - start
+        _, peak_load_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        os.remove(path)
+        if os.path.exists(main.compiled_level_path(path)):
+            os.remove(main.compiled_level_path(path))
+
+    profiler = main.profiler = main.FrameProfiler(args.ticks)
+    profiler.enabled = True
+    for tick in range(args.ticks):
+        random_walk(level, rng, tick)
+        level.is_game_over = False  # Исход уровня бенчмарку не важен
+
+        profiler.begin_frame()
+        level.step()
+        level.draw()
+        profiler.mark("draw")
+        pygame.display.flip()
+        profiler.mark("flip")
+        profiler.end_frame()
+    level.close()
+
+    result = {
+        "size": [len(lines[0]), len(lines)],
+        "enemies": len(level.enemies),
+        "potions": len(level.potions),
+        "ticks": args.ticks,
+        "load_s": load_s,
+        "load_map_s": load_map_s,
+        "peak_load_bytes": peak_load_bytes,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "collision_query_ms": bench_collisions(level, rng),
+        "flow_field": bench_flow_field(level, rng),
+        "field_of_view": bench_field_of_view(level, rng),
+        "movement": bench_movement(level, rng),
+        "phases": {name: percentiles(profiler.samples(name))
+                   for name in ("frame",) + main.FrameProfiler.PHASES[1:]},
+        "assets": main.assets.stats(),
+    }
+    if args.streaming:
+        result["streaming_corridor"] = check_streaming_corridor(args)
+    return result
+
+
+def measure_startup(cache, runs):
+    """Медианное время запуска игры до меню (мс) в отдельных процессах"""
+    env = dict(os.environ, GHOST_SURFACE_CACHE=cache)
+    script = "import main; print(main.Game().startup_ms)"
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                                check=True).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def run_startup(args):
+    """Сравнивает запуск без кэша поверхностей, с пустым кэшем и с заполненным"""
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as cache:
+        return {"startup_ms": {"no_cache": measure_startup("off", args.runs),
+                               "cold_cache": measure_startup(os.path.join(cache, "cold"), 1),
+                               "warm_cache": measure_startup(os.path.join(cache, "cold"), args.runs)}}
+
+
+def flatten(result):
+    """Плоский словарь метрик для сравнения с эталоном"""
+    flat = {name: result[name] for name in COMPARED_METRICS + ["collision_query_ms"]}
+    for phase, stats in result["phases"].items():
+        for name in ("p50_ms", "p90_ms"):  # Хвосты слишком шумные для автоматического сравнения
+            flat[f"{phase}.{name}"] = stats[name]
+    return flat
+
+
+def compare(result, baseline, tolerance):
+    """Список регрессий относительно эталона"""
+    current, reference = flatten(result), flatten(baseline)
+    regressions = []
+    for name, value in current.items():
+        old = reference.get(name)
+        if old and value > old * (1 + tolerance):
+            regressions.append({"metric": name, "baseline": old, "current": value})
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузки, шага симуляции и отрисовки уровня")
+    parser.add_argument("--size", type=int, default=101, help="ширина лабиринта в клетках (до 1000)")
+    parser.add_argument("--height", type=int, default=0, help="высота лабиринта, по умолчанию равна ширине")
+    parser.add_argument("--enemies", type=float, default=0.01, help="доля проходов с врагами")
+    parser.add_argument("--potions", type=float, default=0.002, help="доля проходов с зельями")
+    parser.add_argument("--ticks", type=int, default=600, help="сколько шагов симуляции замерять")
+    parser.add_argument("--streaming", action="store_true", help="подкачивать карту чанками")
+    parser.add_argument("--hunters", action="store_true", help="враги идут к игроку по полю направлений")
+    parser.add_argument("--fog", action="store_true", help="туман войны с расчётом видимости")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tmpdir", default=None, help="куда писать сгенерированную карту")
+    parser.add_argument("--output", help="файл для JSON с результатом (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON эталона для поиска регрессий")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение, доля")
+    parser.add_argument("--startup", action="store_true", help="замерить только время запуска игры")
+    parser.add_argument("--runs", type=int, default=5, help="повторов замера запуска")
+    return parser.parse_args(argv)
+
+
+def bench_main(argv=None):
+    args = parse_args(argv)
+    if args.startup:
+        print(json.dumps(run_startup(args), indent=2))
+        return 0
+    result = run(args)
+
+    exit_code = 0
+    if not result.get("streaming_corridor", {"ok": True})["ok"]:
+        exit_code = 1
+    if args.baseline:
+        with open(args.baseline) as file:
+            result["regressions"] = compare(result, json.load(file), args.tolerance)
+        exit_code = 1 if result["regressions"] else exit_code
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(bench_main())
@@ -0,0 +1,31 @@
+"""Компилятор текстовых карт уровней в двоичный формат .lvl.
+
+Пример:
+    python compile_levels.py                      # все карты из data/levels
+    python compile_levels.py data/levels/hell_level_map.txt
+"""
+import glob
+import os
+import sys
+
+import main
+
+
+def compile_level(map_file):
+    """Компилирует одну текстовую карту рядом с исходником"""
+    grid, spawns = main.read_level_text(map_file)
+    output = main.compiled_level_path(map_file)
+    main.write_compiled_level(output, grid, spawns)
+    return output, os.path.getsize(map_file), os.path.getsize(output)
+
+
+def compile_main(argv=None):
+    map_files = (argv if argv is not None else sys.argv[1:]) or sorted(glob.glob("data/levels/*.txt"))
+    for map_file in map_files:
+        output, text_size, compiled_size = compile_level(map_file)
+        print(f"{map_file} -> {output} ({text_size} -> {compiled_size} байт)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(compile_main())
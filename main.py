@@ -1,7 +1,21 @@
+import atexit
+import hashlib
+import json
+import math
+import mmap
+import os
+import queue
 import random
+import struct
+import threading
 import time
 import sys
+import zlib
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pygame
 
 # ТЕКСТУРЫ И КАРТЫ УРОВНЕЙ
@@ -26,25 +40,523 @@ HELL_LEVEL_TEXTURES = ["textures/levels/Hell/wall.png",
                        ]
 
 
+# Уровни: название -> (текстуры, карта, следующий уровень)
+LEVELS = {"Desert": (DESERT_LEVEL_TEXTURES, DESERT_LEVEL_MAP, "Ocean"),
+          "Ocean": (OCEAN_LEVEL_TEXTURES, OCEAN_LEVEL_MAP, "Hell"),
+          "Hell": (HELL_LEVEL_TEXTURES, HELL_LEVEL_MAP, "Hell")
+          }
+
+# Скомпилированный формат уровня (.lvl): заголовок, сетка по байту на клетку, таблицы спавнов
+LEVEL_MAGIC = b"TLGL"
+LEVEL_VERSION = 1
+# magic, версия, резерв, ширина, высота, x и y игрока (-1 если нет), число врагов, число зелий
+LEVEL_HEADER = struct.Struct("<4sHHIIiiII")
+SPAWN_ENTRY = struct.Struct("<II")
+WALL_TABLE = bytes(1 if code == ord('1') else 0 for code in range(256))  # Символ клетки -> стена
+CLEAR_SPAWNS_TABLE = bytes.maketrans(b"@*#", b"000")  # После спавна клетка становится проходом
+
+# Запись ввода (.rec): заголовок, имя уровня, итог, события по шагам симуляции
+REPLAY_MAGIC = b"TLGR"
+REPLAY_VERSION = 2  # 2: движение с точным касанием стен (старые записи дали бы другой итог)
+REPLAY_HEADER = struct.Struct("<4sHBQ20sH")  # magic, версия, флаги, seed, хэш уровня, длина имени
+# Итог: победа (-1 — нет итога), шаг, x и y игрока, живых врагов, зелий, crc32 позиций врагов
+REPLAY_RESULT = struct.Struct("<bIiiIII")
+REPLAY_HUNTERS = 1  # Флаг: враги-охотники
+RECORD_DIR = os.environ.get("GHOST_RECORD_DIR")  # Если задан, каждый уровень записывается сюда
+
+TICK_RATE = 60  # Шагов симуляции в секунду: скорости заданы в пикселях за шаг
+MAX_FRAME_TIME = 0.25  # Больше этого за один кадр не догоняем, чтобы не уйти в "спираль смерти"
+STATIC_WAIT_MS = 100  # Сколько статичный экран ждёт события, прежде чем проверить фоновую работу
+# Отправлять на дисплей только изменившиеся области; при сдвиге камеры больше предела — полный кадр
+DIRTY_RECTS = os.environ.get("GHOST_DIRTY_RECTS") == "1"
+DIRTY_SCROLL_LIMIT = 64
+HOT_RELOAD = os.environ.get("GHOST_HOT_RELOAD") == "1"  # Режим разработки: правки карты подхватываются на лету
+HOT_RELOAD_INTERVAL = 0.5  # Как часто проверять mtime файла карты, секунды
+FOG = os.environ.get("GHOST_FOG") == "1"  # Туман войны: освещены только клетки, видимые игроку
+FOG_RADIUS = 8  # Дальность обзора в клетках
+FOG_ALPHA = 235  # Непрозрачность тумана над невидимыми клетками
+HUNTERS = os.environ.get("GHOST_HUNTERS") == "1"  # Враги идут к игроку по полю направлений
+
+SAVE_PATH = "data/save.json"
+LEGACY_PROGRESS_PATH = "data/progress.txt"  # Старый формат: по уровню на строку
+SAVE_VERSION = 1
+
+PROFILE_CSV = os.environ.get("GHOST_PROFILE_CSV")  # Если задан, профилировщик включён и пишет CSV при выходе
+VERBOSE = os.environ.get("GHOST_VERBOSE") == "1"  # Печатать время запуска и загрузки уровней в консоль
+# Кэш готовых поверхностей на диске; "off" — выключить
+SURFACE_CACHE_DIR = os.environ.get("GHOST_SURFACE_CACHE", "data/cache")
+SURFACE_CACHE_VERSION = 1
+SURFACE_CACHE_HEADER = struct.Struct("<II")  # Ширина, высота; дальше пиксели BGRA
+
+FONT_PATH = "textures/font/Aladin-Regular.ttf"
+PLAYER_WALK_FRAMES = "textures/player/walk/Playerwalk{}.png"
+PLAYER_IDLE_TEXTURE = "textures/player/PlayerIdle.png"
+ENEMY_WALK_FRAMES = "textures/enemy/Enemywalk{}.png"
+POTION_TEXTURE = "textures/levels/potion.png"
+BACKGROUND_LAYERS = ["textures/background/BG1.png",
+                     "textures/background/BG2.png",
+                     "textures/background/BG3.png"
+                     ]
+
+
+class SurfaceCache:
+    """Готовые (масштабированные, сведённые) поверхности на диске в виде сырых пикселей"""
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, f"v{SURFACE_CACHE_VERSION}")
+
+    def key(self, sources, size, flip):
+        """Ключ по исходникам (путь, mtime, размер файла), целевому размеру и отражению"""
+        parts = [pygame.version.ver, repr(size), str(flip)]
+        for path in sources:
+            stat = os.stat(path)
+            parts += [path, str(stat.st_mtime_ns), str(stat.st_size)]
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+    def read(self, key):
+        """Сырые байты записи или None; можно вызывать из любого потока"""
+        try:
+            with open(os.path.join(self.directory, key + ".raw"), "rb") as file:
+                data = file.read()
+        except OSError:
+            return None
+        if len(data) < SURFACE_CACHE_HEADER.size:
+            return None
+        width, height = SURFACE_CACHE_HEADER.unpack_from(data)
+        if len(data) != SURFACE_CACHE_HEADER.size + width * height * 4:
+            return None  # Недописанная или битая запись
+        return data
+
+    @staticmethod
+    def to_surface(data):
+        """Поверхность прямо поверх байтов записи, без копирования и декодирования"""
+        width, height = SURFACE_CACHE_HEADER.unpack_from(data)
+        return pygame.image.frombuffer(memoryview(data)[SURFACE_CACHE_HEADER.size:], (width, height), "BGRA")
+
+    def write(self, key, surface):
+        """Сохраняет поверхность атомарно; ошибки записи не мешают игре"""
+        path = os.path.join(self.directory, key + ".raw")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "wb") as file:
+                file.write(SURFACE_CACHE_HEADER.pack(*surface.get_size()))
+                file.write(pygame.image.tobytes(surface, "BGRA"))
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+
+class AssetManager:
+    """Общий кэш картинок и шрифтов: каждый ресурс загружается и масштабируется один раз"""
+
+    def __init__(self, disk_cache=None):
+        self.images = {}  # (путь, размер, отражение) -> Surface
+        self.fonts = {}  # (путь, размер) -> Font
+        self.disk_cache = disk_cache  # Производные картинки переживают перезапуск
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    def image(self, path, size=None, flip=False):
+        """Возвращает общую поверхность для картинки нужного размера"""
+        key = (path, size, flip)
+        surface = self.images.get(key)
+        if surface is not None:
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        if size is None and not flip:
+            surface = pygame.image.load(path)
+            if pygame.display.get_surface() is not None:  # convert_alpha требует открытого окна
+                surface = surface.convert_alpha()
+        else:
+            surface = self.load_baked((path,), size, flip)
+            if surface is None:
+                if flip:
+                    surface = pygame.transform.flip(self.image(path, size), True, False)
+                else:
+                    surface = pygame.transform.scale(self.image(path), size)
+                self.store_baked((path,), size, flip, surface)
+        self.images[key] = surface
+        return surface
+
+    def composite(self, paths, size):
+        """Слои, отмасштабированные и сведённые в одну поверхность"""
+        key = (tuple(paths), size, False)
+        surface = self.images.get(key)
+        if surface is not None:
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        surface = self.load_baked(paths, size, False)
+        if surface is None:
+            surface = pygame.Surface(size, pygame.SRCALPHA)
+            for path in paths:
+                surface.blit(self.image(path, size), (0, 0))
+            self.store_baked(paths, size, False, surface)
+        self.images[key] = surface
+        return surface
+
+    def read_baked(self, sources, size, flip):
+        """Байты готовой поверхности с диска или None (только файловый ввод-вывод)"""
+        if self.disk_cache is None:
+            return None
+        return self.disk_cache.read(self.disk_cache.key(sources, size, flip))
+
+    def load_baked(self, sources, size, flip):
+        """Готовая поверхность с диска или None"""
+        if self.disk_cache is None:  # Без дискового кэша нет ни попаданий, ни промахов
+            return None
+        data = self.read_baked(sources, size, flip)
+        if data is None:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        return SurfaceCache.to_surface(data)
+
+    def store_baked(self, sources, size, flip, surface):
+        """Сохраняет готовую поверхность на диск"""
+        if self.disk_cache is not None:
+            self.disk_cache.write(self.disk_cache.key(sources, size, flip), surface)
+
+    def add_baked(self, key, data):
+        """Кладёт в кэш готовую поверхность, прочитанную в другом потоке"""
+        if key not in self.images:
+            self.disk_hits += 1
+            self.images[key] = SurfaceCache.to_surface(data)
+
+    def add_image(self, path, surface):
+        """Кладёт в кэш картинку, декодированную в другом потоке (вызывать из главного)"""
+        if (path, None, False) not in self.images:
+            if pygame.display.get_surface() is not None:
+                surface = surface.convert_alpha()
+            self.images[(path, None, False)] = surface
+
+    def frames(self, pattern, count, size=None, flip=False):
+        """Кадры анимации по шаблону пути с номерами от 1 до count"""
+        return [self.image(pattern.format(i), size, flip) for i in range(1, count + 1)]
+
+    def font(self, path, size):
+        """Возвращает общий объект шрифта"""
+        key = (path, size)
+        font = self.fonts.get(key)
+        if font is not None:
+            self.hits += 1
+            return font
+        self.misses += 1
+        font = self.fonts[key] = pygame.font.Font(path, size)
+        return font
+
+    def memory_bytes(self):
+        """Сколько байт занимают пиксели закэшированных картинок"""
+        return sum(surface.get_pitch() * surface.get_height() for surface in self.images.values())
+
+    def stats(self):
+        """Счётчики кэша"""
+        return {"hits": self.hits, "misses": self.misses, "disk_hits": self.disk_hits,
+                "disk_misses": self.disk_misses, "images": len(self.images),
+                "fonts": len(self.fonts), "image_bytes": self.memory_bytes()}
+
+
+# Один кэш на весь процесс
+assets = AssetManager(SurfaceCache(SURFACE_CACHE_DIR) if SURFACE_CACHE_DIR != "off" else None)
+
+
+def level_asset_keys(level_name):
+    """Картинки, нужные уровню, как ключи кэша ассетов: (путь, размер, отражение)"""
+    tile, sprite = (40, 40), (35, 35)
+    keys = [(path, tile, False) for path in LEVELS[level_name][0]]
+    for pattern in (PLAYER_WALK_FRAMES, ENEMY_WALK_FRAMES):
+        for i in range(1, 6):
+            keys += [(pattern.format(i), sprite, False), (pattern.format(i), sprite, True)]
+    keys += [(PLAYER_IDLE_TEXTURE, sprite, False), (POTION_TEXTURE, tile, False)]
+    return keys
+
+
+class FrameProfiler:
+    """Замеры фаз кадра в кольцевом буфере; выключенный почти ничего не стоит"""
+
+    PHASES = ("events", "player", "enemies", "collisions", "draw", "flip")
+
+    def __init__(self, size=600):
+        self.enabled = False
+        self.show_overlay = False
+        self.size = size  # Сколько последних кадров храним
+        self.history = {name: array('d', bytes(8 * size)) for name in self.PHASES + ("frame",)}
+        self.current = dict.fromkeys(self.PHASES, 0.0)
+        self.index = 0
+        self.count = 0
+        self.frame_start = 0.0
+        self.last_mark = 0.0
+        self.fps = 0.0
+
+    def toggle(self):
+        """Горячая клавиша: включает замеры вместе с оверлеем"""
+        self.show_overlay = not self.show_overlay
+        self.enabled = self.show_overlay or PROFILE_CSV is not None
+        self.frame_start = self.last_mark = time.perf_counter()
+
+    def begin_frame(self):
+        """Начало кадра"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start:
+            interval = now - self.frame_start
+            if interval > 0:  # Сглаженный FPS по интервалу между началами кадров
+                self.fps = self.fps * 0.9 + 0.1 / interval if self.fps else 1 / interval
+        self.frame_start = self.last_mark = now
+
+    def mark(self, phase):
+        """Относит время с прошлой отметки к фазе"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.current[phase] += now - self.last_mark
+        self.last_mark = now
+
+    def end_frame(self):
+        """Записывает кадр в кольцевой буфер"""
+        if not self.enabled:
+            return
+        i = self.index
+        self.history["frame"][i] = time.perf_counter() - self.frame_start
+        for phase in self.PHASES:
+            self.history[phase][i] = self.current[phase]
+            self.current[phase] = 0.0
+        self.index = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self, name):
+        """Значения фазы за сохранённые кадры, от старых к новым (секунды)"""
+        column = self.history[name]
+        start = (self.index - self.count) % self.size
+        return [column[(start + i) % self.size] for i in range(self.count)]
+
+    def draw(self, screen):
+        """Оверлей: FPS, график времени кадра и разбивка по фазам"""
+        if not (self.enabled and self.show_overlay):
+            return
+        panel = pygame.Surface((260, 200), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        font = assets.font(FONT_PATH, 18)
+        lines = [f"FPS: {self.fps:.0f}"]
+        for phase in self.PHASES:
+            recent = self.samples(phase)[-60:]
+            average = sum(recent) / len(recent) * 1000 if recent else 0.0
+            lines.append(f"{phase}: {average:.2f} ms")
+        for i, line in enumerate(lines):
+            panel.blit(font.render(line, True, (255, 255, 255)), (8, 4 + i * 18))
+
+        # График: столбик на кадр, линия — бюджет кадра в 60 FPS
+        frames = self.samples("frame")[-120:]
+        base = 195
+        for i, value in enumerate(frames):
+            height = min(int(value * 1000 * 2), 60)
+            pygame.draw.line(panel, (0, 255, 0) if value < 1 / 60 else (255, 80, 80),
+                             (130 + i, base), (130 + i, base - height))
+        budget_y = base - int(1000 / 60 * 2)
+        pygame.draw.line(panel, (255, 255, 0), (130, budget_y), (250, budget_y))
+        screen.blit(panel, (10, screen.get_height() - 210))
+
+    def dump_csv(self, path):
+        """Сохраняет кольцевой буфер в CSV (миллисекунды)"""
+        columns = [self.samples(name) for name in ("frame",) + self.PHASES]
+        with open(path, "w") as file:
+            file.write("frame_ms," + ",".join(f"{phase}_ms" for phase in self.PHASES) + "\n")
+            for row in zip(*columns):
+                file.write(",".join(f"{value * 1000:.4f}" for value in row) + "\n")
+
+
+profiler = FrameProfiler()  # Общий профилировщик кадров
+
+
+class LevelPreloader:
+    """Фоновая подготовка уровней: карты и картинки читаются в пуле потоков"""
+
+    def __init__(self, workers=2):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preload")
+        self.pending = {}  # Уровень -> Future
+        self.ready = {}  # Уровень -> (сетка, спавны)
+        self.queued = set()  # Ключи картинок, уже отданные в фоновую загрузку
+        self.report = []  # (уровень, попадание в кэш, ожидание в мс)
+
+    def preload(self, level_names):
+        """Ставит уровни в очередь на фоновую загрузку"""
+        for name in level_names:
+            if name not in LEVELS or name in self.pending or name in self.ready:
+                continue
+            keys = [key for key in level_asset_keys(name) if key not in assets.images and key not in self.queued]
+            self.queued.update(keys)
+            self.pending[name] = self.executor.submit(self.load_in_background, LEVELS[name][1], keys)
+
+    @staticmethod
+    def load_in_background(map_file, keys):
+        """В рабочем потоке: готовые поверхности читаются с диска, остальное декодируется"""
+        baked, decoded = {}, {}
+        for path, size, flip in keys:
+            data = assets.read_baked((path,), size, flip)
+            if data is not None:
+                baked[(path, size, flip)] = data
+            elif path not in decoded:
+                decoded[path] = pygame.image.load(path)
+        return load_level(map_file), baked, decoded
+
+    def poll(self, limit=1):
+        """В главном потоке: доводит до готовности не больше limit уровней за кадр"""
+        for name in [name for name, future in self.pending.items() if future.done()][:limit]:
+            self.finish(name)
+
+    def finish(self, name):
+        """Конвертирует и масштабирует поверхности уровня в главном потоке"""
+        level, baked, decoded = self.pending.pop(name).result()  # Если уровень ещё грузится — ждём
+        for key, data in baked.items():
+            assets.add_baked(key, data)
+        for path, surface in decoded.items():
+            assets.add_image(path, surface)
+        for path, size, flip in level_asset_keys(name):
+            assets.image(path, size, flip)
+        assets.font(FONT_PATH, 36)  # Шрифт таймеров
+        self.ready[name] = level
+
+    def take(self, name):
+        """Данные для старта уровня: копия сетки (её можно менять) и спавны"""
+        started = time.perf_counter()
+        hit = name in self.ready
+        if not hit:
+            self.preload([name])
+            self.finish(name)
+        grid, spawns = self.ready[name]
+        self.report.append((name, hit, (time.perf_counter() - started) * 1000))
+        return TileGrid(grid.width, grid.height, bytearray(grid.cells)), spawns
+
+
+class SaveStore:
+    """Прогресс и время прохождения в памяти; на диск их пишет фоновый поток"""
+
+    def __init__(self, path=SAVE_PATH, legacy_path=LEGACY_PROGRESS_PATH, delay=0.5):
+        self.path = path
+        self.delay = delay  # Окно, за которое изменения собираются в одну запись
+        self.completed = set()  # Открытые уровни
+        self.times = {}  # Уровень -> {"best": секунды, "last": секунды}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.changed = False
+        self.closing = False
+        self.writes = 0
+        self.load(legacy_path)
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def load(self, legacy_path):
+        """Читает сохранение; после сбоя пробует недописанную временную копию"""
+        for candidate in (self.path, self.path + ".tmp"):
+            try:
+                with open(candidate, "r") as file:
+                    data = json.load(file)
+            except (OSError, ValueError):
+                continue
+            if data.get("version") == SAVE_VERSION:
+                self.completed.update(data.get("completed", []))
+                self.times.update(data.get("times", {}))
+                return
+
+        # Первый запуск: переносим старый progress.txt
+        try:
+            with open(legacy_path, "r") as file:
+                self.completed.update(line.strip() for line in file if line.strip())
+        except FileNotFoundError:
+            return
+        self.changed = True
+        self.wakeup.set()
+
+    def complete_level(self, level_name):
+        """Открывает уровень"""
+        with self.lock:
+            if level_name in self.completed:
+                return
+            self.completed.add(level_name)
+            self.changed = True
+        self.wakeup.set()
+
+    def record_time(self, level_name, seconds):
+        """Запоминает последнее и лучшее время прохождения"""
+        with self.lock:
+            entry = self.times.setdefault(level_name, {"best": None, "last": None})
+            entry["last"] = seconds
+            if entry["best"] is None or seconds < entry["best"]:
+                entry["best"] = seconds
+            self.changed = True
+        self.wakeup.set()
+
+    def best_time(self, level_name):
+        """Лучшее время уровня или None, без обращения к диску"""
+        return self.times.get(level_name, {}).get("best")
+
+    def writer(self):
+        """Фоновый поток: пачками пишет изменения на диск"""
+        while True:
+            self.wakeup.wait()
+            if not self.closing:
+                time.sleep(self.delay)
+            self.wakeup.clear()
+            with self.lock:
+                data = None
+                if self.changed:
+                    data = {"version": SAVE_VERSION, "completed": sorted(self.completed),
+                            "times": {name: dict(entry) for name, entry in self.times.items()}}
+                    self.changed = False
+            if data is not None:
+                self.write(data)
+            if self.closing:
+                return
+
+    def write(self, data):
+        """Атомарная запись: временный файл, fsync, rename"""
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(data, file, indent=2)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.path)
+            self.writes += 1
+        except OSError:
+            with self.lock:
+                self.changed = True  # Попробуем ещё раз при следующем изменении
+
+    def close(self):
+        """Дописывает несохранённые изменения и останавливает поток"""
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join(timeout=5)
+
+
 class MainScreen:
+    static = True  # Меню перерисовывается только при изменениях
+
     def __init__(self, screen, completed_levels, game):
         """Инициализация главного экрана"""
         self.screen = screen
         self.completed_levels = completed_levels
         self.game = game  # Сохраняем ссылку на игру
-        self.background_layers = [
-            pygame.image.load("textures/background/BG1.png").convert_alpha(),
-            pygame.image.load("textures/background/BG2.png").convert_alpha(),
-            pygame.image.load("textures/background/BG3.png").convert_alpha()
-        ]
-        self.font_small = pygame.font.Font("textures/font/Aladin-Regular.ttf", 30)
-        self.font_large = pygame.font.Font("textures/font/Aladin-Regular.ttf", 60)
+        self.background = assets.composite(BACKGROUND_LAYERS, (800, 600))  # Три слоя фона, сведённые в один
+        self.font_small = assets.font(FONT_PATH, 30)
+        self.font_large = assets.font(FONT_PATH, 60)
+        self.resume()
+
+    def resume(self):
+        """Возврат в меню: могли открыться уровни и смениться рекорды"""
+        self.dirty = True
+        # Пока меню простаивает, готовим открытые уровни
+        self.game.preloader.preload(["Desert"] + sorted(self.completed_levels))
 
     def draw(self):
-        """Отрисовка всех слоев фона"""
-        for layer in self.background_layers:
-            layer = pygame.transform.scale(layer, (800, 600))
-            self.screen.blit(layer, (0, 0))
+        """Отрисовка фона и меню"""
+        self.screen.blit(self.background, (0, 0))
 
         text_top = self.font_small.render("Developer: UnRobWarrior", True, (255, 255, 255))
         self.screen.blit(text_top, (10, 10))
@@ -62,6 +574,11 @@ class MainScreen:
             button_rect = button.get_rect(center=(400, 300 + i * 50))
             self.screen.blit(button, button_rect)
 
+            best = self.game.save.best_time(text)
+            if best is not None:  # Лучшее время берётся из памяти
+                best_text = self.font_small.render(f"{best:.1f}s", True, (200, 200, 200))
+                self.screen.blit(best_text, best_text.get_rect(midleft=(470, 300 + i * 50)))
+
     def handle_click(self, x, y):
         """Обработка кликов"""
         if 350 < x < 450:
@@ -72,39 +589,93 @@ class MainScreen:
             elif 385 < y < 415 and "Hell" in self.completed_levels:
                 self.game.start_level("Hell")
 
+    def handle_event(self, event):
+        """События меню"""
+        if event.type == pygame.MOUSEBUTTONDOWN:
+            self.handle_click(*event.pos)
+
     def update(self):
         """Обновление экрана"""
+        self.game.preloader.poll()
+        if not (self.dirty or profiler.show_overlay):
+            return
+        self.dirty = False
         self.draw()
+        profiler.mark("draw")
+        profiler.draw(self.screen)
         pygame.display.flip()
+        profiler.mark("flip")
+
+
+class ResultScreen:
+    static = True
+
+    def __init__(self, screen, game, victory, elapsed_time):
+        """Экран итога уровня"""
+        self.screen = screen
+        self.game = game
+        self.dirty = True
+
+        font = assets.font(FONT_PATH, 48)
+        message = "Victory!" if victory else "Defeat!"
+        self.text = font.render(message, True, (255, 0, 0))
+        self.text_rect = self.text.get_rect(center=(screen.get_width() // 2, screen.get_height() // 3))
+
+        time_font = assets.font(FONT_PATH, 42)
+        self.time_text = time_font.render(f"Time: {int(elapsed_time)}", True, (255, 0, 0))
+        self.time_rect = self.time_text.get_rect(center=(screen.get_width() // 2, screen.get_height() // 2 - 50))
+
+        button_font = assets.font(FONT_PATH, 36)
+        self.button_text = button_font.render("OK", True, (255, 0, 0))
+        self.button_rect = pygame.Rect(screen.get_width() // 2 - 100, screen.get_height() // 2, 200, 100)
+
+    def draw(self):
+        """Отрисовка итога и кнопки"""
+        self.screen.fill("BLACK")
+        self.screen.blit(self.text, self.text_rect)
+        self.screen.blit(self.time_text, self.time_rect)
+        pygame.draw.rect(self.screen, (0, 0, 0), self.button_rect)
+        self.screen.blit(self.button_text, self.button_text.get_rect(center=self.button_rect.center))
+
+    def handle_event(self, event):
+        """Кнопка OK возвращает в меню"""
+        if event.type == pygame.MOUSEBUTTONDOWN and self.button_rect.collidepoint(event.pos):
+            self.game.return_to_menu()
+
+    def update(self):
+        """Перерисовка только при изменениях"""
+        if not (self.dirty or profiler.show_overlay):
+            return
+        self.dirty = False
+        self.draw()
+        profiler.mark("draw")
+        profiler.draw(self.screen)
+        pygame.display.flip()
+        profiler.mark("flip")
 
 
 class Player:
     def __init__(self, x, y):
         self.x = x * 40  # Преобразуем координаты из клеток в пиксели
         self.y = y * 40
+        self.prev_x = self.x  # Позиция на прошлом шаге (для интерполяции)
+        self.prev_y = self.y
         self.speed = 5  # Скорость движения
         self.velocity_x = 0
         self.velocity_y = 0
         self.state_rage = False
 
-        # Загрузка кадров анимации
-        fremes = [pygame.image.load(f"textures/player/walk/Playerwalk{i}.png").convert_alpha() for i in range(1, 6)]
-        self.frames_right = list()
-        for i in fremes:
-            i = pygame.transform.scale(i, (35, 35))
-            self.frames_right.append(i)
-        self.frames_left = [pygame.transform.flip(frame, True, False) for frame in self.frames_right]
+        # Кадры анимации общие для всех экземпляров
+        self.frames_right = assets.frames(PLAYER_WALK_FRAMES, 5, (35, 35))
+        self.frames_left = assets.frames(PLAYER_WALK_FRAMES, 5, (35, 35), flip=True)
         self.frames_up = self.frames_right  # Можно добавить отдельную анимацию вверх
         self.frames_down = self.frames_right  # Можно добавить отдельную анимацию вниз
 
         # Текстура для состояния покоя
-        self.idle_frame = pygame.transform.scale(pygame.image.load("textures/player/PlayerIdle.png").convert_alpha(),
-                                                 (35, 35))
+        self.idle_frame = assets.image(PLAYER_IDLE_TEXTURE, (35, 35))
 
         self.current_frames = self.frames_down  # По умолчанию используем кадры для движения вниз
-        self.current_frame_index = 0
-        self.animation_speed = 0.2  # Скорость анимации (кадры в секунду)
-        self.last_update = pygame.time.get_ticks()
+        self.animation = AnimationClock(len(self.frames_right), 0.2)  # Часы листа кадров игрока
         self.is_moving = False  # Флаг движения
 
     def handle_input(self, event):
@@ -129,57 +700,36 @@ class Player:
             elif event.key in (pygame.K_a, pygame.K_d):
                 self.velocity_x = 0
 
-    def update(self, level_map):
-        """Обновляет позицию игрока, проверяя столкновения"""
-        new_x = self.x + self.velocity_x
-        new_y = self.y + self.velocity_y
-
-        # Двигаем игрока отдельно по X и Y, если нет коллизии
-        if not self.check_collision(new_x, self.y, level_map):
-            self.x = new_x
+    def update(self, walls, now):
+        """Обновляет позицию игрока, проверяя столкновения; now — время симуляции в мс"""
+        self.prev_x, self.prev_y = self.x, self.y
 
-        if not self.check_collision(self.x, new_y, level_map):
-            self.y = new_y
+        # Двигаем игрока отдельно по X и Y до касания стены: так он скользит вдоль стен вплотную
+        left, top, right, bottom = self.hitbox(self.x, self.y)
+        self.x += walls.sweep_x(left, top, right, bottom, self.velocity_x)
+        left, top, right, bottom = self.hitbox(self.x, self.y)
+        self.y += walls.sweep_y(left, top, right, bottom, self.velocity_y)
 
         # Определяем, движется ли игрок
         self.is_moving = self.velocity_x != 0 or self.velocity_y != 0
 
         # Обновление анимации только если игрок двигается
         if self.is_moving:
-            now = pygame.time.get_ticks()
-            if now - self.last_update > self.animation_speed * 1000:
-                self.last_update = now
-                self.current_frame_index = (self.current_frame_index + 1) % len(self.current_frames)
+            self.animation.advance(now)
 
-    def check_collision(self, x, y, level_map):
-        """Проверяет, есть ли перед игроком стена с уменьшенным хитбоксом"""
+    def hitbox(self, x, y):
+        """Уменьшенный хитбокс в позиции (x, y): левый, верхний, правый, нижний пиксели включительно"""
         hitbox_offset = 7  # Отступ с каждой стороны (уменьшение хитбокса)
         hitbox_size = 25  # Новый размер хитбокса
+        return x + hitbox_offset, y + hitbox_offset, x + hitbox_offset + hitbox_size, y + hitbox_offset + hitbox_size
 
-        # Четыре точки по краям уменьшенного хитбокса
-        corners = [
-            (int((x + hitbox_offset) // 40), int((y + hitbox_offset) // 40)),  # Верхний левый угол
-            (int((x + hitbox_offset + hitbox_size) // 40), int((y + hitbox_offset) // 40)),  # Верхний правый
-            (int((x + hitbox_offset) // 40), int((y + hitbox_offset + hitbox_size) // 40)),  # Нижний левый
-            (int((x + hitbox_offset + hitbox_size) // 40), int((y + hitbox_offset + hitbox_size) // 40))
-            # Нижний правый
-        ]
-
-        for grid_x, grid_y in corners:
-            if level_map[grid_y][grid_x] == '1':  # Стена
-                return True
-
-        return False
-
-    def draw(self, screen, camera):
-        """Рисует игрока с учетом смещения камеры"""
-        screen_x, screen_y = camera.apply(self)
+    def sprite(self, camera):
+        """Текущий кадр и его позиция на экране"""
         if self.is_moving:
-            current_frame = self.current_frames[self.current_frame_index]
+            current_frame = self.current_frames[self.animation.frame]
         else:
             current_frame = self.idle_frame  # Если игрок стоит, рисуем Idle-кадр
-
-        screen.blit(current_frame, (screen_x, screen_y))
+        return current_frame, camera.apply(self)
 
     def activate_rage(self):
         """Активирует состояние ярости"""
@@ -192,89 +742,197 @@ class Player:
         self.speed = 5
 
 
-class Enemy:
-    def __init__(self, x, y):
-        self.x = x * 40  # Преобразуем координаты в пиксели
-        self.y = y * 40
-        self.speed = 2  # Скорость движения
-        self.direction = random.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])  # Рандомное направление
-
-        # Загрузка анимаций
-        frames = [pygame.image.load(f"textures/enemy/Enemywalk{i}.png").convert_alpha() for i in range(1, 6)]
-        self.frames_right = [pygame.transform.scale(frame, (35, 35)) for frame in frames]
-        self.frames_left = [pygame.transform.flip(frame, True, False) for frame in self.frames_right]
-        self.frames_up = self.frames_right  # Если будут разные анимации - замени
-        self.frames_down = self.frames_right
-
-        self.current_frames = self.frames_down  # По умолчанию идет вниз
-        self.current_frame_index = 0
-        self.animation_speed = 0.2  # Скорость анимации
-        self.last_update = pygame.time.get_ticks()
-
-    def update(self, level_map):
-        """Обновляет движение врага и анимацию"""
-        new_x = self.x + self.direction[0] * self.speed
-        new_y = self.y + self.direction[1] * self.speed
-
-        if not self.check_collision(new_x, new_y, level_map):
-            self.x = new_x
-            self.y = new_y
-        else:
-            self.change_direction()
-
-        # Обновление анимации
-        now = pygame.time.get_ticks()
-        if now - self.last_update > self.animation_speed * 1000:
-            self.last_update = now
-            self.current_frame_index = (self.current_frame_index + 1) % len(self.current_frames)
-
-        # Обновляем анимацию
-        now = pygame.time.get_ticks()
-        if now - self.last_update > self.animation_speed * 1000:
-            self.last_update = now
-            self.current_frame_index = (self.current_frame_index + 1) % len(self.current_frames)
-
-    def change_direction(self):
-        """Меняет направление движения при столкновении"""
-        directions = [(1, 0), (-1, 0), (0, 1), (0, -1)]
-        directions.remove(self.direction)  # Исключаем текущее направление
-        self.direction = random.choice(directions)
-
-        # Обновляем текущую анимацию
-        if self.direction == (1, 0):  # Вправо
-            self.current_frames = self.frames_right
-        elif self.direction == (-1, 0):  # Влево
-            self.current_frames = self.frames_left
-        elif self.direction == (0, -1):  # Вверх
-            self.current_frames = self.frames_up
-        elif self.direction == (0, 1):  # Вниз
-            self.current_frames = self.frames_down
-
-    def check_collision(self, x, y, level_map):
-        """Проверяет, столкнулся ли враг со стеной"""
-        enemy_rect = pygame.Rect(x, y, 40, 40)  # Хитбокс врага
-
-        for row_idx, row in enumerate(level_map):
-            for col_idx, tile in enumerate(row):
-                if tile == '1':  # Стены
-                    wall_rect = pygame.Rect(col_idx * 40, row_idx * 40, 40, 40)
-                    if enemy_rect.colliderect(wall_rect):  # Проверка пересечения
-                        return True
-        return False
-
-    def draw(self, screen, camera):
-        """Рисует врага на экране с учетом камеры"""
-        screen_x, screen_y = camera.apply(self)
-        screen.blit(self.current_frames[self.current_frame_index], (screen_x, screen_y))
+class SpatialHash:
+    """Равномерная сетка для поиска соседей: клетка -> множество id сущностей"""
+
+    def __init__(self, cell_size=80):
+        self.cell_size = cell_size  # В пикселях
+        self.cells = {}  # (cx, cy) -> set(id)
+        self.keys = {}  # id -> (cx, cy)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, item, x, y):
+        """Добавляет сущность с левым верхним углом в (x, y)"""
+        key = (int(x // self.cell_size), int(y // self.cell_size))
+        self.keys[item] = key
+        self.cells.setdefault(key, set()).add(item)
+
+    def move(self, item, x, y):
+        """Переносит сущность; сетка меняется, только если сменилась клетка"""
+        key = (int(x // self.cell_size), int(y // self.cell_size))
+        old = self.keys[item]
+        if key != old:
+            self.remove(item)
+            self.keys[item] = key
+            self.cells.setdefault(key, set()).add(item)
+
+    def remove(self, item):
+        """Убирает сущность за O(1)"""
+        key = self.keys.pop(item)
+        bucket = self.cells[key]
+        bucket.discard(item)
+        if not bucket:
+            del self.cells[key]
+
+    def query(self, left, top, right, bottom):
+        """id сущностей, чей левый верхний угол может лежать в [left, right] x [top, bottom]"""
+        found = []
+        for cy in range(int(top // self.cell_size), int(bottom // self.cell_size) + 1):
+            for cx in range(int(left // self.cell_size), int(right // self.cell_size) + 1):
+                bucket = self.cells.get((cx, cy))
+                if bucket:
+                    found.extend(bucket)
+        return found
+
+
+class EnemySwarm:
+    """Все враги уровня одной структурой массивов NumPy: шаг считается операциями над целыми массивами"""
+
+    DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))  # Вправо, влево, вниз, вверх
+    STEPS_X = np.array((1, -1, 0, 0), dtype=np.int32)  # Столбцы DIRECTIONS для выборки по массиву направлений
+    STEPS_Y = np.array((0, 0, 1, -1), dtype=np.int32)
+    speed = 2  # Скорость движения; меньше клетки, поэтому за шаг край врага пересекает не больше одной границы
+    animation_speed = 0.2  # Скорость анимации
+
+    def __init__(self, spawns, rng):
+        self.rng = rng  # Свой генератор уровня: одинаковый seed — одинаковое поведение
+        self.xs = np.array([x * 40 for x, _ in spawns], dtype=np.int32)  # Преобразуем координаты в пиксели
+        self.ys = np.array([y * 40 for _, y in spawns], dtype=np.int32)
+        self.prev_xs = self.xs.copy()
+        self.prev_ys = self.ys.copy()
+        self.directions = np.array([rng.randrange(4) for _ in spawns], dtype=np.int8)  # Индекс в DIRECTIONS
+        self.facing = np.zeros(len(spawns), dtype=np.int8)  # 0 — кадры вправо, 1 — влево
+        # Убитые враги помечаются, а не удаляются: индексы остаются стабильными
+        self.alive = np.ones(len(spawns), dtype=bool)
+        self.count = len(spawns)
+
+        # Индекс соседей обновляется по ходу движения
+        self.index = SpatialHash()
+        for i, (x, y) in enumerate(spawns):
+            self.index.insert(i, x * 40, y * 40)
+
+        # Анимации берутся из общего кэша, а не грузятся для каждого врага
+        self.frames = (assets.frames(ENEMY_WALK_FRAMES, 5, (35, 35)),
+                       assets.frames(ENEMY_WALK_FRAMES, 5, (35, 35), flip=True))
+        # Все враги ходят в ногу: кадр берётся из общих часов листа, а не из таймера каждого врага
+        self.animation = AnimationClock(len(self.frames[0]), self.animation_speed)
+
+    def __len__(self):
+        return self.count
+
+    def update(self, walls, now, loaded_mask=None, flow=None):
+        """Шаг всех врагов пачкой; loaded_mask — маска незамороженных (подкачанных) клеток,
+        flow — поле направлений к игроку, если враги охотятся"""
+        xs, ys, directions, facing = self.xs, self.ys, self.directions, self.facing
+        self.animation.advance(now)
+        np.copyto(self.prev_xs, xs)
+        np.copyto(self.prev_ys, ys)
+
+        active = self.alive
+        if loaded_mask is not None:
+            active = active & loaded_mask(xs // 40, ys // 40)
+        if flow is not None:
+            # Ровно в клетке охотник сворачивает к игроку; вне поля бродит как обычно
+            for i in np.flatnonzero(active & (xs % 40 == 0) & (ys % 40 == 0)).tolist():
+                direction = flow.direction(int(xs[i]) // 40, int(ys[i]) // 40)
+                if direction >= 0:
+                    directions[i] = direction
+                    facing[i] = direction == 1
+
+        moving = np.flatnonzero(active)
+        x, y, direction = xs[moving], ys[moving], directions[moving]
+        full_step = (self.STEPS_X[direction] + self.STEPS_Y[direction]) * self.speed
+        horizontal = self.STEPS_X[direction] != 0
+        forward = full_step > 0
+
+        # Хитбокс врага 40x40: передний край — последний пиксель (+39) при движении вперёд, первый при движении назад
+        along = np.where(horizontal, x, y)
+        edge = along + np.where(forward, 39, 0)
+        cell = (edge + full_step) // 40
+        # Стены проверяем только у тех, чей край переходит в новую клетку; поперёк хитбокс лежит в одной-двух клетках
+        crossing = np.flatnonzero(cell != edge // 40)
+        hit = np.zeros(len(moving), dtype=bool)
+        if crossing.size:
+            across = np.where(horizontal, y, x)[crossing]
+            ahead, sideways = cell[crossing], horizontal[crossing]
+            for side in (across // 40, (across + 39) // 40):
+                hit[crossing] |= walls.walls_at(np.where(sideways, ahead, side), np.where(sideways, side, ahead))
+        # Упёршийся враг встаёт вплотную к стене, как в WallGrid.sweep_x/sweep_y
+        contact = np.where(forward, cell * 40 - 1 - edge, (cell + 1) * 40 - edge)
+        step = np.where(hit, contact, full_step)
+
+        new_x = np.where(horizontal, x + step, x)
+        new_y = np.where(horizontal, y, y + step)
+        xs[moving] = new_x
+        ys[moving] = new_y
+        # Индекс соседей трогаем только у врагов, сменивших его клетку
+        cell_size = self.index.cell_size
+        moved = np.flatnonzero((new_x // cell_size != x // cell_size) | (new_y // cell_size != y // cell_size))
+        for i, nx, ny in zip(moving[moved].tolist(), new_x[moved].tolist(), new_y[moved].tolist()):
+            self.index.move(i, nx, ny)
+
+        # Упёршиеся меняют направление на любое другое; случайные числа тратятся по порядку индексов,
+        # как при поштучном обходе, поэтому записи ввода воспроизводятся
+        blocked = moving[step != full_step]
+        if blocked.size:
+            rolls = np.array([self.rng.randrange(3) for _ in range(blocked.size)], dtype=np.int8)
+            turned = rolls + (rolls >= directions[blocked])  # То же, что choice() из трёх оставшихся
+            directions[blocked] = turned
+            facing[blocked] = turned == 1
+
+    def add(self, x, y):
+        """Добавляет врага в клетку (x, y); возвращает его id"""
+        i = len(self.xs)
+        self.xs = np.append(self.xs, np.int32(x * 40))  # Редкая операция (правка карты), копия массивов допустима
+        self.ys = np.append(self.ys, np.int32(y * 40))
+        self.prev_xs = np.append(self.prev_xs, np.int32(x * 40))
+        self.prev_ys = np.append(self.prev_ys, np.int32(y * 40))
+        self.directions = np.append(self.directions, np.int8(self.rng.randrange(4)))
+        self.facing = np.append(self.facing, np.int8(0))
+        self.alive = np.append(self.alive, True)
+        self.count += 1
+        self.index.insert(i, x * 40, y * 40)
+        return i
+
+    def remove(self, i):
+        """Удаляет врага i за O(1): помечает мёртвым и убирает из индекса"""
+        if self.alive[i]:
+            self.alive[i] = False
+            self.count -= 1
+            self.index.remove(i)
+
+    def near(self, left, top, right, bottom):
+        """Живые враги, чей левый верхний угол может лежать в прямоугольнике, по порядку спавна"""
+        return sorted(self.index.query(left, top, right, bottom))
+
+    def sprites(self, camera):
+        """Кадры и экранные позиции видимых врагов с учетом камеры и интерполяции"""
+        alpha = camera.alpha
+        left, top = camera.offset_x, camera.offset_y
+        width, height = camera.width, camera.height
+        xs, ys, prev_xs, prev_ys, facing = self.xs, self.ys, self.prev_xs, self.prev_ys, self.facing
+        # Кандидатов даёт индекс соседей; запас на шаг — интерполяция отстаёт от позиции
+        margin = 40 + self.speed
+        frame = self.animation.frame
+        frames = (self.frames[0][frame], self.frames[1][frame])
+        near = np.array(self.near(left - margin, top - margin, left + width + self.speed, top + height + self.speed),
+                        dtype=np.intp)
+        x = prev_xs[near] + (xs[near] - prev_xs[near]) * alpha - left
+        y = prev_ys[near] + (ys[near] - prev_ys[near]) * alpha - top
+        shown = (-40 < x) & (x < width) & (-40 < y) & (y < height)
+        return [(frames[side], (sx, sy))
+                for side, sx, sy in zip(facing[near[shown]].tolist(), x[shown].tolist(), y[shown].tolist())]
 
 
 class Potion:
     def __init__(self, x, y):
         self.x = x * 40  # Преобразуем координаты из клеток в пиксели
         self.y = y * 40
-        self.texture = pygame.image.load(
-            "textures/levels/potion.png").convert_alpha()  # Загружаем текстуру зелья
-        self.texture = pygame.transform.scale(self.texture, (40, 40))  # Масштабируем текстуру
+        self.prev_x = self.x  # Зелье неподвижно
+        self.prev_y = self.y
+        self.texture = assets.image(POTION_TEXTURE, (40, 40))  # Общая текстура зелья
 
     def check_collision(self, player):
         """Проверяет столкновение зелья с игроком"""
@@ -282,10 +940,9 @@ class Potion:
         player_rect = pygame.Rect(player.x, player.y, 35, 35)  # Хитбокс игрока
         return potion_rect.colliderect(player_rect)  # Проверяем пересечение
 
-    def draw(self, screen, camera):
-        """Отрисовывает зелье с учетом камеры"""
-        screen_x, screen_y = camera.apply(self)
-        screen.blit(self.texture, (screen_x, screen_y))
+    def sprite(self, camera):
+        """Текстура и позиция на экране"""
+        return self.texture, camera.apply(self)
 
 
 class Camera:
@@ -294,155 +951,1275 @@ class Camera:
         self.offset_y = 0
         self.width = width
         self.height = height
+        self.alpha = 1.0  # Доля пути между прошлым и текущим шагом симуляции
+
+    def position(self, entity):
+        """Интерполированная позиция сущности между шагами симуляции"""
+        return (entity.prev_x + (entity.x - entity.prev_x) * self.alpha,
+                entity.prev_y + (entity.y - entity.prev_y) * self.alpha)
 
     def update(self, player):
         """Следит за игроком и обновляет смещение"""
-        self.offset_x = player.x - self.width // 2
-        self.offset_y = player.y - self.height // 2
+        x, y = self.position(player)
+        self.offset_x = x - self.width // 2
+        self.offset_y = y - self.height // 2
 
     def apply(self, entity):
         """Возвращает координаты сущности с учетом смещения камеры"""
-        return entity.x - self.offset_x, entity.y - self.offset_y
+        x, y = self.position(entity)
+        return x - self.offset_x, y - self.offset_y
 
     def apply_tile(self, x, y, tile_size):
         """Возвращает координаты тайла с учетом камеры"""
         return x * tile_size - self.offset_x, y * tile_size - self.offset_y
 
 
+class TileGrid:
+    """Карта уровня: по одному байту (символу формата карт) на клетку"""
+
+    def __init__(self, width, height, cells, source=None):
+        self.width = width
+        self.height = height
+        self.cells = cells  # bytearray или участок mmap
+        self.source = source  # mmap, который должен жить вместе с сеткой
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Сетка из строк текстовой карты; короткие строки добиваются пустотой"""
+        width = max((len(line) for line in lines), default=0)
+        cells = bytearray(b"".join(line.encode("ascii").ljust(width) for line in lines))
+        return cls(width, len(lines), cells)
+
+    def get(self, x, y):
+        """Символ клетки; за пределами карты — пустота"""
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return chr(self.cells[y * self.width + x])
+        return ' '
+
+    def set(self, x, y, tile):
+        """Меняет клетку"""
+        self.cells[y * self.width + x] = ord(tile)
+
+    def row_slice(self, y, x0, x1):
+        """Байты клеток строки y от x0 до x1"""
+        return self.cells[y * self.width + x0:y * self.width + x1]
+
+    def is_loaded(self, x, y):
+        """Загружена ли клетка в память (обычная карта загружена целиком)"""
+        return True
+
+    def find_all(self, tile):
+        """Координаты всех клеток с символом tile, построчно"""
+        code = tile.encode("ascii")
+        cells = bytes(self.cells) if isinstance(self.cells, memoryview) else self.cells
+        found = []
+        index = cells.find(code)
+        while index != -1:
+            found.append((index % self.width, index // self.width))
+            index = cells.find(code, index + 1)
+        return found
+
+
+def compiled_level_path(map_file):
+    """Путь к скомпилированной версии текстовой карты"""
+    return os.path.splitext(map_file)[0] + ".lvl"
+
+
+def read_level_text(map_file):
+    """Читает текстовую карту: сетка со стёртыми спавнами и таблицы спавнов"""
+    with open(map_file, "r") as file:
+        grid = TileGrid.from_lines([line.strip() for line in file])
+    players = grid.find_all('@')
+    spawns = (players[0] if players else None, grid.find_all('*'), grid.find_all('#'))
+    grid.cells = grid.cells.translate(CLEAR_SPAWNS_TABLE)
+    return grid, spawns
+
+
+def write_compiled_level(path, grid, spawns):
+    """Сохраняет уровень в компактном двоичном формате"""
+    player, enemies, potions = spawns
+    player_x, player_y = player if player else (-1, -1)
+    with open(path, "wb") as file:
+        file.write(LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, 0, grid.width, grid.height,
+                                     player_x, player_y, len(enemies), len(potions)))
+        file.write(grid.cells)
+        for x, y in enemies + potions:
+            file.write(SPAWN_ENTRY.pack(x, y))
+
+
+def read_compiled_level(path):
+    """Открывает .lvl через mmap: сетка читается прямо из отображённого файла"""
+    with open(path, "rb") as file:
+        # ACCESS_COPY: правки сетки во время игры не попадают в файл
+        source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    magic, version, _, width, height, player_x, player_y, enemy_count, potion_count = \
+        LEVEL_HEADER.unpack_from(source)
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+        source.close()
+        raise ValueError(f"{path}: неподдерживаемый формат уровня")
+
+    offset = LEVEL_HEADER.size
+    grid = TileGrid(width, height, memoryview(source)[offset:offset + width * height], source)
+    offset += width * height
+    entries = [SPAWN_ENTRY.unpack_from(source, offset + i * SPAWN_ENTRY.size)
+               for i in range(enemy_count + potion_count)]
+    player = (player_x, player_y) if player_x >= 0 else None
+    return grid, (player, entries[:enemy_count], entries[enemy_count:])
+
+
+def ensure_compiled_level(map_file):
+    """Путь к актуальному .lvl, при необходимости компилирует текстовую карту"""
+    compiled = compiled_level_path(map_file)
+    if not os.path.exists(compiled) or os.path.getmtime(compiled) < os.path.getmtime(map_file):
+        write_compiled_level(compiled, *read_level_text(map_file))
+    return compiled
+
+
+def load_level(map_file):
+    """Загружает скомпилированный уровень, если он свежее текстового, иначе текст"""
+    compiled = compiled_level_path(map_file)
+    if os.path.exists(compiled) and os.path.getmtime(compiled) >= os.path.getmtime(map_file):
+        return read_compiled_level(compiled)
+    return read_level_text(map_file)
+
+
+class LevelWatcher:
+    """Следит за файлом карты опросом mtime (не чаще раза в interval секунд)"""
+
+    def __init__(self, path, interval=HOT_RELOAD_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.mtime = os.path.getmtime(path)
+        self.next_check = time.perf_counter() + interval
+
+    def changed(self):
+        """True, если файл изменился с прошлой проверки"""
+        now = time.perf_counter()
+        if now < self.next_check:
+            return False
+        self.next_check = now + self.interval
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:  # Редактор может сохранять через удаление и переименование
+            return False
+        if mtime == self.mtime:
+            return False
+        self.mtime = mtime
+        return True
+
+
+class WallGrid:
+    """Индекс занятости клеток стенами"""
+
+    def __init__(self, grid, tile_size=40):
+        self.tile_size = tile_size
+        self.height = grid.height
+        self.width = grid.width
+        self.cells = bytearray(grid.cells).translate(WALL_TABLE)  # 1 — стена, 0 — свободно
+
+    def is_wall(self, x, y):
+        """Есть ли стена в клетке (x, y); за пределами карты стен нет"""
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.cells[y * self.width + x] == 1
+        return False
+
+    def set_wall(self, x, y, is_wall):
+        """Обновляет занятость одной клетки"""
+        self.cells[y * self.width + x] = 1 if is_wall else 0
+
+    def walls_at(self, xs, ys):
+        """Маска стен для массивов клеток (NumPy); за пределами карты стен нет"""
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        cells = np.frombuffer(self.cells, dtype=np.uint8)  # Вид на тот же bytearray, без копии
+        return inside & (cells[np.where(inside, ys * self.width + xs, 0)] == 1)
+
+    def overlaps(self, left, top, right, bottom):
+        """Проверяет, задевает ли прямоугольник [left, right] x [top, bottom] (в пикселях) стену"""
+        first_x = int(left // self.tile_size)
+        first_y = int(top // self.tile_size)
+        last_x = int(right // self.tile_size)
+        last_y = int(bottom // self.tile_size)
+        for grid_y in range(first_y, last_y + 1):
+            for grid_x in range(first_x, last_x + 1):
+                if self.is_wall(grid_x, grid_y):
+                    return True
+        return False
+
+    def sweep_x(self, left, top, right, bottom, dx):
+        """Сдвиг прямоугольника по X на dx пикселей до касания стены.
+
+        Проверяются только столбцы клеток, которые пересечёт передний край, поэтому
+        стену нельзя проскочить на любой скорости. Координаты и сдвиг могут быть дробными
+        (шаг, умноженный на dt): касание считается по пикселю, в котором лежит край, и
+        дробная часть позиции сохраняется. Возвращает допустимый сдвиг.
+        """
+        size = self.tile_size
+        left_pixel = math.floor(left)
+        right_pixel = math.floor(right)
+        first_y = math.floor(top) // size
+        last_y = math.floor(bottom) // size
+        if dx > 0:
+            for grid_x in range(right_pixel // size + 1, math.floor(right + dx) // size + 1):
+                for grid_y in range(first_y, last_y + 1):
+                    if self.is_wall(grid_x, grid_y):
+                        return grid_x * size - 1 - right_pixel  # Правый край встаёт вплотную к стене
+        elif dx < 0:
+            for grid_x in range(left_pixel // size - 1, math.floor(left + dx) // size - 1, -1):
+                for grid_y in range(first_y, last_y + 1):
+                    if self.is_wall(grid_x, grid_y):
+                        return (grid_x + 1) * size - left_pixel
+        return dx
+
+    def sweep_y(self, left, top, right, bottom, dy):
+        """Сдвиг прямоугольника по Y на dy пикселей до касания стены (см. sweep_x)"""
+        size = self.tile_size
+        top_pixel = math.floor(top)
+        bottom_pixel = math.floor(bottom)
+        first_x = math.floor(left) // size
+        last_x = math.floor(right) // size
+        if dy > 0:
+            for grid_y in range(bottom_pixel // size + 1, math.floor(bottom + dy) // size + 1):
+                for grid_x in range(first_x, last_x + 1):
+                    if self.is_wall(grid_x, grid_y):
+                        return grid_y * size - 1 - bottom_pixel
+        elif dy < 0:
+            for grid_y in range(top_pixel // size - 1, math.floor(top + dy) // size - 1, -1):
+                for grid_x in range(first_x, last_x + 1):
+                    if self.is_wall(grid_x, grid_y):
+                        return (grid_y + 1) * size - top_pixel
+        return dy
+
+
+class FlowField:
+    """Поле направлений к игроку: один BFS на смену клетки игрока, общий для всех врагов"""
+
+    def __init__(self, walls, max_distance=48):
+        self.walls = walls
+        self.max_distance = max_distance  # Дальше (в шагах) враги игрока не чуют
+        self.target = None  # Клетка игрока, для которой посчитано поле
+        self.steps = {}  # (x, y) -> индекс направления в EnemySwarm.DIRECTIONS к игроку
+        self.recomputes = 0
+
+    def update(self, tile_x, tile_y):
+        """Пересчитывает поле, только если игрок сменил клетку"""
+        if (tile_x, tile_y) == self.target:
+            return
+        self.target = (tile_x, tile_y)
+        self.recomputes += 1
+
+        walls = self.walls
+        steps = {(tile_x, tile_y): -1}  # В клетке игрока идти уже некуда
+        frontier = [(tile_x, tile_y)]
+        for _ in range(self.max_distance):
+            next_frontier = []
+            for x, y in frontier:
+                for direction, (dx, dy) in enumerate(EnemySwarm.DIRECTIONS):
+                    cell = (x + dx, y + dy)
+                    if cell in steps or not (0 <= cell[0] < walls.width and 0 <= cell[1] < walls.height):
+                        continue
+                    if not walls.is_wall(*cell):
+                        steps[cell] = direction ^ 1  # Обратный шаг ведёт к игроку
+                        next_frontier.append(cell)
+            frontier = next_frontier
+            if not frontier:
+                break
+        self.steps = steps
+
+    def direction(self, tile_x, tile_y):
+        """Направление к игроку из клетки или -1, если клетка вне поля"""
+        return self.steps.get((tile_x, tile_y), -1)
+
+
+class FieldOfView:
+    """Видимые из клетки клетки: рекурсивное затенение (shadowcasting) по сетке стен, с LRU-кэшем"""
+
+    # Множители перехода из координат октанта в координаты сетки: (xx, xy, yx, yy)
+    OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+               (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+    def __init__(self, walls, radius=FOG_RADIUS, cache_size=256):
+        self.walls = walls
+        self.radius = radius
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (x, y) -> frozenset видимых клеток; по коридорам ходят туда-обратно
+        self.hits = 0
+        self.misses = 0
+
+    def visible(self, x, y):
+        """Клетки, видимые из (x, y), включая стены, на которые падает взгляд"""
+        key = (x, y)
+        cells = self.cache.get(key)
+        if cells is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return cells
+        self.misses += 1
+
+        found = {key}
+        for xx, xy, yx, yy in self.OCTANTS:
+            self.cast(found, x, y, 1, 1.0, 0.0, xx, xy, yx, yy)
+        cells = frozenset(found)
+        self.cache[key] = cells
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return cells
+
+    def cast(self, cells, cx, cy, row, start, end, xx, xy, yx, yy):
+        """Один октант: идёт по рядам от центра, сужая конус за каждой стеной"""
+        if start < end:
+            return
+        radius = self.radius
+        radius_squared = radius * radius
+        is_wall = self.walls.is_wall
+        for j in range(row, radius + 1):
+            dx = -j - 1
+            dy = -j
+            blocked = False
+            new_start = start
+            while dx <= 0:
+                dx += 1
+                x = cx + dx * xx + dy * xy
+                y = cy + dx * yx + dy * yy
+                left_slope = (dx - 0.5) / (dy + 0.5)
+                right_slope = (dx + 0.5) / (dy - 0.5)
+                if start < right_slope:
+                    continue
+                if end > left_slope:
+                    break
+                if dx * dx + dy * dy <= radius_squared:
+                    cells.add((x, y))
+                if blocked:
+                    if is_wall(x, y):  # Тень продолжается
+                        new_start = right_slope
+                        continue
+                    blocked = False
+                    start = new_start
+                elif is_wall(x, y) and j < radius:
+                    # Стена разрезает конус: часть до неё досматриваем рекурсивно
+                    blocked = True
+                    self.cast(cells, cx, cy, j + 1, start, left_slope, xx, xy, yx, yy)
+                    new_start = right_slope
+            if blocked:
+                break
+
+    def reset(self):
+        """Стены изменились: всё посчитанное устарело"""
+        self.cache.clear()
+
+
+class FogOfWar:
+    """Туман войны: одна заранее созданная поверхность затемнения с вырезанными видимыми клетками"""
+
+    def __init__(self, walls, tile_size, screen_size, radius=FOG_RADIUS):
+        self.fov = FieldOfView(walls, radius)
+        self.tile_size = tile_size
+        # Запас в две клетки с каждой стороны: камера следует за спрайтом, а не за клеткой
+        self.columns = screen_size[0] // tile_size + 4
+        self.rows = screen_size[1] // tile_size + 4
+        self.overlay = pygame.Surface((self.columns * tile_size, self.rows * tile_size), pygame.SRCALPHA)
+        self.tile = None  # Клетка игрока, для которой построено затемнение
+        self.origin = (0, 0)  # Клетка левого верхнего угла затемнения
+        self.rebuilds = 0
+
+    def update(self, tile_x, tile_y):
+        """Перестраивает затемнение при смене клетки игрока; True, если картинка изменилась"""
+        if (tile_x, tile_y) == self.tile:
+            return False
+        self.tile = (tile_x, tile_y)
+        self.rebuilds += 1
+
+        left = tile_x - self.columns // 2
+        top = tile_y - self.rows // 2
+        self.origin = (left, top)
+        size = self.tile_size
+        overlay = self.overlay
+        overlay.fill((0, 0, 0, FOG_ALPHA))
+        clear = (0, 0, 0, 0)
+        for x, y in self.fov.visible(tile_x, tile_y):
+            if 0 <= x - left < self.columns and 0 <= y - top < self.rows:
+                overlay.fill(clear, ((x - left) * size, (y - top) * size, size, size))
+        return True
+
+    def reset(self):
+        """Стены изменились: пересчитать видимость при следующем кадре"""
+        self.fov.reset()
+        self.tile = None
+
+    def draw(self, screen, camera):
+        """Одна отрисовка затемнения поверх тайлов и спрайтов"""
+        screen.blit(self.overlay, camera.apply_tile(self.origin[0], self.origin[1], self.tile_size))
+
+
+class LevelStreamer:
+    """Уровень, подкачиваемый чанками вокруг игрока в фоновом потоке (LRU с бюджетом памяти)"""
+
+    def __init__(self, path, radius, tile_size=40, chunk_size=32, budget_bytes=256 * 1024):
+        with open(path, "rb") as file:
+            self.source = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.width, self.height, player_x, player_y, enemy_count, potion_count = \
+            LEVEL_HEADER.unpack_from(self.source)
+        if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+            self.source.close()
+            raise ValueError(f"{path}: неподдерживаемый формат уровня")
+
+        self.tile_size = tile_size
+        self.chunk_size = chunk_size  # Размер чанка в клетках
+        self.radius = radius  # Сколько клеток вокруг игрока держать загруженными (по x, по y)
+        self.budget_bytes = budget_bytes
+        self.grid_offset = LEVEL_HEADER.size
+
+        # Таблицы спавнов лежат после сетки; саму сетку целиком не читаем
+        offset = self.grid_offset + self.width * self.height
+        entries = [SPAWN_ENTRY.unpack_from(self.source, offset + i * SPAWN_ENTRY.size)
+                   for i in range(enemy_count + potion_count)]
+        player = (player_x, player_y) if player_x >= 0 else None
+        self.spawns = (player, entries[:enemy_count], entries[enemy_count:])
+
+        self.pages = OrderedDict()  # (cx, cy) -> bytearray chunk_size x chunk_size
+        self.wanted = set()  # Чанки вокруг игрока, их не выгружаем
+        self.requested = set()  # Чанки в очереди на загрузку
+        self.bounds = None  # Диапазон чанков (first_x, last_x, first_y, last_y), по которому считали wanted
+        self.loads = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def read_chunk(self, cx, cy):
+        """Читает чанк из файла; клетки за краем карты — пустота"""
+        size = self.chunk_size
+        page = bytearray(b" " * (size * size))
+        x0, y0 = cx * size, cy * size
+        width = min(size, self.width - x0)
+        for row in range(min(size, self.height - y0)):
+            offset = self.grid_offset + (y0 + row) * self.width + x0
+            page[row * size:row * size + width] = self.source[offset:offset + width]
+        return page
+
+    def worker(self):
+        """Фоновый поток: загружает чанки из очереди и выгружает лишние"""
+        page_bytes = self.chunk_size * self.chunk_size
+        while True:
+            key = self.queue.get()
+            if key is None:
+                self.queue.task_done()
+                return
+            page = self.read_chunk(*key)
+            with self.lock:
+                self.requested.discard(key)
+                self.pages[key] = page
+                self.loads += 1
+                while len(self.pages) * page_bytes > self.budget_bytes:
+                    victim = next((old for old in self.pages if old not in self.wanted), None)
+                    if victim is None:  # Всё нужное не влезает в бюджет — выходим за него
+                        break
+                    del self.pages[victim]
+                    self.evictions += 1
+            self.queue.task_done()
+
+    def request_around(self, tile_x, tile_y, wait=False):
+        """Ставит в очередь чанки вокруг клетки; wait — дождаться загрузки"""
+        size = self.chunk_size
+        radius_x, radius_y = self.radius
+        first_x, last_x = max(tile_x - radius_x, 0) // size, min(tile_x + radius_x, self.width - 1) // size
+        first_y, last_y = max(tile_y - radius_y, 0) // size, min(tile_y + radius_y, self.height - 1) // size
+        # Радиус дотягивается до соседнего чанка раньше, чем игрок в него войдёт, поэтому сравниваем диапазон
+        bounds = (first_x, last_x, first_y, last_y)
+        if bounds != self.bounds:
+            self.bounds = bounds
+            wanted = {(cx, cy) for cy in range(first_y, last_y + 1) for cx in range(first_x, last_x + 1)}
+            with self.lock:
+                self.wanted = wanted
+                for key in wanted:
+                    if key in self.pages:
+                        self.pages.move_to_end(key)
+                    elif key not in self.requested:
+                        self.requested.add(key)
+                        self.queue.put(key)
+        if wait:
+            self.queue.join()
+
+    def close(self):
+        """Останавливает фоновый поток"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def is_loaded(self, x, y):
+        """Загружен ли чанк с клеткой (x, y)"""
+        return (x // self.chunk_size, y // self.chunk_size) in self.pages
+
+    def loaded_mask(self, xs, ys):
+        """Маска клеток из загруженных чанков для массивов координат (NumPy)"""
+        columns = math.ceil(self.width / self.chunk_size)
+        rows = math.ceil(self.height / self.chunk_size)
+        loaded = np.zeros(rows * columns, dtype=bool)
+        with self.lock:
+            for cx, cy in self.pages:
+                loaded[cy * columns + cx] = True
+        cxs, cys = xs // self.chunk_size, ys // self.chunk_size
+        inside = (cxs >= 0) & (cxs < columns) & (cys >= 0) & (cys < rows)
+        return inside & loaded[np.where(inside, cys * columns + cxs, 0)]
+
+    def get(self, x, y):
+        """Символ клетки; невыгруженные клетки считаются стеной"""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return ' '
+        page = self.pages.get((x // self.chunk_size, y // self.chunk_size))
+        if page is None:
+            return '1'
+        return chr(page[(y % self.chunk_size) * self.chunk_size + x % self.chunk_size])
+
+    def set(self, x, y, tile):
+        """Меняет клетку загруженного чанка"""
+        page = self.pages.get((x // self.chunk_size, y // self.chunk_size))
+        if page is not None:
+            page[(y % self.chunk_size) * self.chunk_size + x % self.chunk_size] = ord(tile)
+
+    def row_slice(self, y, x0, x1):
+        """Байты клеток строки y от x0 до x1 (невыгруженные — стены)"""
+        size = self.chunk_size
+        parts = []
+        x = x0
+        while x < x1:
+            end = min(x1, (x // size + 1) * size)
+            page = self.pages.get((x // size, y // size))
+            if page is None:
+                parts.append(b"1" * (end - x))
+            else:
+                start = (y % size) * size + x % size
+                parts.append(page[start:start + end - x])
+            x = end
+        return b"".join(parts)
+
+    def is_wall(self, x, y):
+        """Стена ли в клетке; за пределами карты стен нет, невыгруженное — стена"""
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.get(x, y) == '1'
+        return False
+
+    def walls_at(self, xs, ys):
+        """Маска стен для массивов клеток; чанки лежат отдельно, поэтому по клетке (их немного — только
+        те, у кого край врага перешёл в новую клетку)"""
+        return np.fromiter(map(self.is_wall, xs.tolist(), ys.tolist()), dtype=bool, count=len(xs))
+
+    def set_wall(self, x, y, is_wall):
+        """Стены берутся из самих клеток, отдельного индекса нет"""
+
+    # Тот же обход клеток под хитбоксом, но со своим is_wall
+    overlaps = WallGrid.overlaps
+    sweep_x = WallGrid.sweep_x
+    sweep_y = WallGrid.sweep_y
+
+
+class TileRenderer:
+    """Кэш статичного слоя тайлов, разбитый на чанки"""
+
+    def __init__(self, grid, textures, tile_size=40, chunk_size=16, viewport=(800, 600), spare_chunks=4):
+        self.grid = grid
+        self.tile_size = tile_size
+        self.chunk_size = chunk_size  # Размер чанка в тайлах
+        # Сколько запечённых чанков держим в памяти: все, что может задеть окно камеры
+        # (по чанку запаса на каждую ось из-за смещения), и немного на шаги назад
+        chunk_pixels = chunk_size * tile_size
+        self.max_chunks = ((math.ceil(viewport[0] / chunk_pixels) + 1) *
+                           (math.ceil(viewport[1] / chunk_pixels) + 1) + spare_chunks)
+        self.textures = textures  # Уже отмасштабированы под tile_size (см. AssetManager)
+        # Текстуры по коду байта клетки; пустота (пробел) остаётся чёрной
+        self.textures_by_code = {ord(tile): texture for tile, texture in textures.items()}
+        self.textures_by_code[ord(' ')] = None
+        self.chunks = OrderedDict()  # (cx, cy) -> Surface, в порядке последнего использования
+
+    def set_tile(self, x, y, tile):
+        """Меняет клетку карты и сбрасывает только её чанк"""
+        if self.grid.get(x, y) != tile:
+            self.grid.set(x, y, tile)
+            self.invalidate(x, y)
+
+    def invalidate(self, x, y):
+        """Сбрасывает чанк, содержащий клетку (x, y)"""
+        self.chunks.pop((x // self.chunk_size, y // self.chunk_size), None)
+
+    def bake_chunk(self, cx, cy):
+        """Запекает тайлы чанка в одну поверхность"""
+        size = self.chunk_size * self.tile_size
+        surface = pygame.Surface((size, size))
+        surface.fill((0, 0, 0))
+        default = self.textures['0']
+        grid = self.grid
+        x0, y0 = cx * self.chunk_size, cy * self.chunk_size
+        x1 = min(x0 + self.chunk_size, grid.width)
+        for y in range(y0, min(y0 + self.chunk_size, grid.height)):
+            row = grid.row_slice(y, x0, x1)
+            for x, code in enumerate(row, x0):
+                texture = self.textures_by_code.get(code, default)
+                if texture is not None:
+                    surface.blit(texture, ((x - x0) * self.tile_size, (y - y0) * self.tile_size))
+        return surface
+
+    def get_chunk(self, cx, cy):
+        """Возвращает запечённый чанк, при необходимости запекая его"""
+        key = (cx, cy)
+        surface = self.chunks.get(key)
+        if surface is None:
+            x0, y0 = cx * self.chunk_size, cy * self.chunk_size
+            x1 = min(x0 + self.chunk_size, self.grid.width) - 1
+            y1 = min(y0 + self.chunk_size, self.grid.height) - 1
+            if not (self.grid.is_loaded(x0, y0) and self.grid.is_loaded(x1, y1)):
+                return None  # Данные ещё подкачиваются — не запекаем неполный чанк
+            surface = self.bake_chunk(cx, cy)
+            self.chunks[key] = surface
+            if len(self.chunks) > self.max_chunks:
+                self.chunks.popitem(last=False)  # Выкидываем давно не использованный чанк
+        else:
+            self.chunks.move_to_end(key)
+        return surface
+
+    def draw(self, screen, camera):
+        """Рисует только чанки, попадающие в окно камеры"""
+        chunk_pixels = self.chunk_size * self.tile_size
+        last_cx = (self.grid.width - 1) // self.chunk_size
+        last_cy = (self.grid.height - 1) // self.chunk_size
+
+        first_x = max(int(camera.offset_x // chunk_pixels), 0)
+        first_y = max(int(camera.offset_y // chunk_pixels), 0)
+        end_x = min(int((camera.offset_x + camera.width - 1) // chunk_pixels), last_cx)
+        end_y = min(int((camera.offset_y + camera.height - 1) // chunk_pixels), last_cy)
+
+        for cy in range(first_y, end_y + 1):
+            for cx in range(first_x, end_x + 1):
+                surface = self.get_chunk(cx, cy)
+                if surface is not None:
+                    screen.blit(surface, camera.apply_tile(cx, cy, chunk_pixels))
+
+
+class AnimationClock:
+    """Часы анимации листа кадров, общие для всех, кто его показывает"""
+
+    def __init__(self, frame_count, interval):
+        self.frame_count = frame_count
+        self.interval = interval * 1000  # Секунды на кадр -> мс
+        self.last_update = 0  # Время симуляции в мс
+        self.frame = 0
+
+    def advance(self, now):
+        """Переключает кадр, если прошёл интервал; now — время симуляции в мс"""
+        if now - self.last_update > self.interval:
+            self.last_update = now
+            self.frame = (self.frame + 1) % self.frame_count
+
+
+class SpriteBatch:
+    """Спрайты кадра: собираются с отсечением по экрану и рисуются одним Surface.blits"""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.items = []  # (поверхность, позиция) в порядке отрисовки
+
+    def begin(self):
+        """Новый кадр"""
+        self.items.clear()
+
+    def add(self, surface, position):
+        """Добавляет спрайт, если он хоть частично на экране"""
+        x, y = position
+        if -surface.get_width() < x < self.width and -surface.get_height() < y < self.height:
+            self.items.append((surface, position))
+
+    def extend(self, sprites):
+        """Добавляет уже отсечённые спрайты"""
+        self.items.extend(sprites)
+
+    def draw(self, screen):
+        """Один вызов blits на все спрайты кадра"""
+        screen.blits(self.items, False)
+
+
+class HudText:
+    """Строка HUD: поверхность текста рендерится заново только при смене значения"""
+
+    def __init__(self, size, color, template):
+        self.font = assets.font(FONT_PATH, size)
+        self.color = color
+        self.template = template
+        self.value = None
+        self.surface = None
+
+    def render(self, value):
+        if value != self.value or self.surface is None:
+            self.value = value
+            self.surface = self.font.render(self.template.format(value), True, self.color)
+        return self.surface
+
+
+class DirtyRenderer:
+    """Отрисовка уровня, при которой на дисплей уходят только изменившиеся области.
+
+    Экран прошлого кадра сдвигается вслед за камерой (scroll), заново рисуются
+    открывшиеся полосы, старые и новые места спрайтов и изменившийся HUD.
+    """
+
+    def __init__(self, screen, scroll_limit=DIRTY_SCROLL_LIMIT):
+        self.screen = screen
+        self.scroll_limit = scroll_limit
+        self.offset = None  # Смещение камеры прошлого кадра; None — нужен полный кадр
+        self.sprite_rects = []  # Где спрайты были в прошлом кадре
+        self.hud = []  # (поверхность, rect) HUD прошлого кадра
+        self.rects = None  # Области к отправке; None — полный flip
+        self.full_frames = 0
+        self.partial_frames = 0
+
+    @staticmethod
+    def merge(rects, bounds):
+        """Обрезает прямоугольники по экрану и сливает пересекающиеся"""
+        merged = []
+        for rect in rects:
+            rect = rect.clip(bounds)
+            if not rect.w or not rect.h:
+                continue
+            i = rect.collidelist(merged)
+            while i != -1:
+                rect = rect.union(merged.pop(i))
+                i = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def render(self, level):
+        """Рисует кадр уровня; камера уже обновлена"""
+        screen = self.screen
+        camera = level.camera
+        # Целое смещение: иначе сдвинутая картинка расходится с нарисованной заново
+        camera.offset_x = int(camera.offset_x // 1)
+        camera.offset_y = int(camera.offset_y // 1)
+        offset = (camera.offset_x, camera.offset_y)
+
+        sprites = level.sprites()
+        # +1 пиксель со всех сторон на округление дробных позиций при blit
+        sprite_rects = [pygame.Rect(int(x) - 1, int(y) - 1, frame.get_width() + 2, frame.get_height() + 2)
+                        for frame, (x, y) in sprites]
+        hud = level.hud()
+
+        if self.offset is None:
+            dx = dy = self.scroll_limit + 1
+        else:
+            dx, dy = offset[0] - self.offset[0], offset[1] - self.offset[1]
+        full = level.dirty or profiler.show_overlay or abs(dx) > self.scroll_limit or abs(dy) > self.scroll_limit
+        self.offset = offset
+        level.dirty = False
+
+        if full:
+            level.draw_background()
+            screen.blits(sprites, False)
+            level.draw_fog()
+            screen.blits(hud, False)
+            self.rects = None
+            self.full_frames += 1
+        else:
+            dirty = [rect.move(-dx, -dy) for rect in self.sprite_rects] + sprite_rects
+            if dx or dy:
+                screen.scroll(-dx, -dy)
+                width, height = screen.get_size()
+                if dx:
+                    dirty.append(pygame.Rect(width - dx if dx > 0 else 0, 0, abs(dx), height))
+                if dy:
+                    dirty.append(pygame.Rect(0, height - dy if dy > 0 else 0, width, abs(dy)))
+            for (surface, rect), (old_surface, old_rect) in zip(hud, self.hud + [(None, None)] * len(hud)):
+                if dx or dy or surface is not old_surface or rect != old_rect:
+                    dirty.append(rect)
+                    if old_rect is not None:
+                        dirty.append(old_rect.move(-dx, -dy))
+            for old_surface, old_rect in self.hud[len(hud):]:  # Пропавшая строка HUD
+                dirty.append(old_rect.move(-dx, -dy))
+
+            self.rects = self.merge(dirty, screen.get_rect())
+            for rect in self.rects:
+                screen.set_clip(rect)
+                level.draw_background()
+                screen.blits(sprites, False)
+                level.draw_fog()
+                screen.blits(hud, False)
+            screen.set_clip(None)
+            self.partial_frames += 1
+
+        self.sprite_rects = sprite_rects
+        self.hud = hud
+
+    def present(self):
+        """Отправляет кадр на дисплей"""
+        if self.rects is None:
+            profiler.draw(self.screen)
+            pygame.display.flip()
+        else:
+            pygame.display.update(self.rects)
+
+
+class SimClock:
+    """Часы симуляции с фиксированным шагом"""
+
+    def __init__(self, tick_rate=TICK_RATE):
+        self.dt = 1 / tick_rate  # Длительность шага в секундах
+        self.ticks = 0
+
+    def now(self):
+        """Время симуляции в секундах"""
+        return self.ticks * self.dt
+
+    def advance(self):
+        """Переходит к следующему шагу"""
+        self.ticks += 1
+
+
+class InputRecorder:
+    """Компактная запись ввода игрока по шагам симуляции"""
+
+    KEYS = (pygame.K_w, pygame.K_s, pygame.K_a, pygame.K_d)  # Кодируются индексом в 2 бита
+
+    def __init__(self, level_name, seed, level_hash, flags=0):
+        self.level_name = level_name
+        self.seed = seed
+        self.level_hash = level_hash
+        self.flags = flags
+        self.events = bytearray()  # Пары: разница шагов (varint), код события
+        self.count = 0
+        self.last_tick = 0
+
+    def record(self, tick, event):
+        """Запоминает нажатие или отпускание клавиши управления"""
+        if event.type not in (pygame.KEYDOWN, pygame.KEYUP) or event.key not in self.KEYS:
+            return
+        delta = tick - self.last_tick
+        self.last_tick = tick
+        while delta >= 0x80:  # LEB128: по 7 бит на байт
+            self.events.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        self.events.append(delta)
+        self.events.append(self.KEYS.index(event.key) | (4 if event.type == pygame.KEYUP else 0))
+        self.count += 1
+
+    def save(self, path, result):
+        """Пишет запись вместе с итогом уровня"""
+        name = self.level_name.encode("utf-8")
+        with open(path, "wb") as file:
+            file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.flags, self.seed,
+                                          self.level_hash, len(name)))
+            file.write(name)
+            file.write(REPLAY_RESULT.pack(*result))
+            file.write(struct.pack("<I", self.count))
+            file.write(self.events)
+
+
+def read_recording(path):
+    """Читает запись ввода: параметры уровня, итог и список (шаг, тип события, клавиша)"""
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, version, flags, seed, level_hash, name_length = REPLAY_HEADER.unpack_from(data)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError(f"{path}: неподдерживаемый формат записи")
+    offset = REPLAY_HEADER.size
+    level_name = data[offset:offset + name_length].decode("utf-8")
+    offset += name_length
+    result = REPLAY_RESULT.unpack_from(data, offset)
+    offset += REPLAY_RESULT.size
+    count, = struct.unpack_from("<I", data, offset)
+    offset += 4
+
+    events = []
+    tick = 0
+    for _ in range(count):
+        delta = shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            delta |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        tick += delta
+        code = data[offset]
+        offset += 1
+        event_type = pygame.KEYUP if code & 4 else pygame.KEYDOWN
+        events.append((tick, event_type, InputRecorder.KEYS[code & 3]))
+    return {"level_name": level_name, "seed": seed, "level_hash": level_hash, "flags": flags,
+            "result": result, "events": events}
+
+
 class ShowLevel:
-    def __init__(self, screen, textures, map, next_level, game):
+    static = False  # Игровая сцена рисует каждый кадр с ограничением частоты
+
+    def __init__(self, screen, textures, map, next_level, game, clock=None, headless=False, streaming=False,
+                 seed=None, level_data=None, name=None, hunters=False, record_path=None, dirty_rects=DIRTY_RECTS,
+                 fog=FOG, hot_reload=HOT_RELOAD):
         self.screen = screen
-        self.game = game  # Сохраняем ссылку на объект Game
+        self.name = name  # Название уровня (для сохранения времени)
+        self.game = game  # Сохраняем ссылку на объект Game (None в режиме без окна)
+        self.headless = headless  # Без окна: только симуляция, без отрисовки
+        self.streaming = streaming  # Карта подкачивается чанками вокруг игрока
+        self.clock = clock or SimClock()  # Все игровые таймеры идут по часам симуляции
+        # Все случайности уровня идут от одного seed, чтобы партию можно было воспроизвести
+        self.seed = seed if seed is not None else random.randrange(2 ** 63)
+        self.rng = random.Random(self.seed)
         self.tile_size = 40
-        self.start_time = time.time()
+        self.start_time = self.clock.now()
+        self.victory = None  # Итог уровня: True/False после завершения
+        self.elapsed_time = 0
         self.load_textures(textures)
-        self.load_map(map)
+        if level_data is not None and not streaming:
+            self.map_data, self.spawns = level_data  # Карта уже прочитана предзагрузкой
+        else:
+            self.load_map(map)
         self.next_level = next_level
+        # Горячая перезагрузка карты; подкачиваемые уровни читаются из .lvl и не следят за текстом
+        self.watcher = LevelWatcher(map) if hot_reload and not streaming else None
 
         # Атрибуты ярости игрока
         self.state_player_rage = False
         self.rage_start_time = 0  # Время активации ярости
+        self.kills = 0  # Враги, уничтоженные в ярости
 
         # Создаем камеру
         self.camera = Camera(screen.get_width(), screen.get_height())
 
-        # Ищем стартовую позицию игрока
-        self.player = None
-        self.enemies = []  # Список врагов
-        self.potions = []  # Список зелий
-
         self.is_game_over = False  # Флаг завершения уровня
 
-        for y, row in enumerate(self.map_data):
-            for x, tile in enumerate(row):
-                if tile == '@':
-                    self.player = Player(x, y)
-                    self.map_data[y][x] = '0'
-                elif tile == '*':  # Враг
-                    self.enemies.append(Enemy(x, y))
-                    self.map_data[y][x] = '0'  # Очищаем клетку
-                elif tile == '#':  # Зелье
-                    self.potions.append(Potion(x, y))
-                    self.map_data[y][x] = '0'
+        # Сущности создаются по таблицам спавнов, клетки карты уже очищены
+        player_spawn, enemy_spawns, potion_spawns = self.spawns
+        self.player = Player(*player_spawn) if player_spawn else None
+        self.enemies = EnemySwarm(enemy_spawns, self.rng)  # Враги
+        self.enemy_origins = list(enemy_spawns)  # Клетка спавна каждого врага по id
+        self.potions = [Potion(x, y) for x, y in potion_spawns]  # Список зелий
+        self.potion_index = SpatialHash()  # id зелья — его место в списке
+        for i, potion in enumerate(self.potions):
+            self.potion_index.insert(i, potion.x, potion.y)
+
+        # Накопитель реального времени для фиксированного шага
+        self.accumulator = 0.0
+        self.last_frame_time = time.perf_counter()
+
+        if self.streaming:
+            # Стены читаются прямо из подкачанных чанков; стартовую область грузим сразу
+            self.walls = self.map_data
+            self.map_data.request_around(self.player.x // self.tile_size, self.player.y // self.tile_size, wait=True)
+        else:
+            # Индекс стен строится один раз на уровень
+            self.walls = WallGrid(self.map_data, self.tile_size)
+
+        # Охотники идут к игроку по общему полю направлений
+        self.flow_field = FlowField(self.walls) if hunters else None
+
+        # Запись ввода (в потоковом режиме партия зависит от подкачки и не воспроизводима)
+        self.record_path = record_path
+        self.recorder = None
+        self.final_state = None  # Итог уровня для сверки с записью
+        if record_path is not None and not streaming:
+            self.recorder = InputRecorder(name or "", self.seed, self.level_hash(),
+                                          REPLAY_HUNTERS if hunters else 0)
+
+        # Статичный слой тайлов запекается по чанкам
+        self.tile_renderer = TileRenderer(self.map_data, self.textures, self.tile_size,
+                                          viewport=screen.get_size())
+
+        # HUD: текст перерисовывается раз в секунду, а не каждый кадр
+        self.timer_text = HudText(36, (255, 255, 255), "Time: {}s")
+        self.rage_text = HudText(36, (189, 0, 183), "Time of rage: {}s")
+        self.sprite_batch = SpriteBatch(screen.get_width(), screen.get_height())
+        self.dirty = True  # Следующий кадр нужно нарисовать целиком
+        self.dirty_renderer = DirtyRenderer(screen) if dirty_rects and not headless else None
+        self.fog = FogOfWar(self.walls, self.tile_size, screen.get_size()) if fog and not headless else None
 
     def load_textures(self, textures):
         """Загрузка текстур"""
+        size = (self.tile_size, self.tile_size)
         self.textures = {
-            '1': pygame.image.load(textures[0]).convert_alpha(),  # Стена
-            '0': pygame.image.load(textures[1]).convert_alpha(),  # Проход
-            '2': pygame.image.load(textures[2]).convert_alpha(),  # Выход
-            '@': pygame.image.load(textures[1]).convert_alpha(),  # Игрок (будет заменён на класс)
-            '#': pygame.image.load(textures[1]).convert_alpha(),  # Зелье
-            '*': pygame.image.load(textures[1]).convert_alpha()  # Враг (будет заменён на класс)
+            '1': assets.image(textures[0], size),  # Стена
+            '0': assets.image(textures[1], size),  # Проход
+            '2': assets.image(textures[2], size),  # Выход
         }
 
     def load_map(self, filename):
-        """Загрузка карты"""
-        with open(filename, "r") as file:
-            self.map_data = [list(line.strip()) for line in file]
+        """Загрузка карты (скомпилированной .lvl, если есть, иначе текстовой)"""
+        if self.streaming:
+            # Радиус подкачки: половина экрана плюс полчанка запаса на подлёт камеры
+            radius = (self.screen.get_width() // self.tile_size // 2 + 16,
+                      self.screen.get_height() // self.tile_size // 2 + 16)
+            self.map_data = LevelStreamer(ensure_compiled_level(filename), radius, self.tile_size)
+            self.spawns = self.map_data.spawns
+        else:
+            self.map_data, self.spawns = load_level(filename)
+
+    def close(self):
+        """Освобождает ресурсы уровня (поток подкачки)"""
+        if self.streaming:
+            self.map_data.close()
+
+    def reload_map(self):
+        """Применяет правки файла карты к идущему уровню: только изменившиеся клетки и спавны"""
+        try:
+            grid, spawns = read_level_text(self.watcher.path)
+        except (OSError, UnicodeDecodeError, ValueError):  # Файл могли поймать посреди записи
+            return
+        old = self.map_data
+        changed = 0
+        if (grid.width, grid.height) != (old.width, old.height):
+            # Размер изменился: клетки не сопоставить, пересобираем сетку целиком
+            self.map_data = grid
+            self.walls = WallGrid(grid, self.tile_size)
+            self.tile_renderer = TileRenderer(grid, self.textures, self.tile_size,
+                                              viewport=self.screen.get_size())
+            if self.flow_field is not None:
+                self.flow_field = FlowField(self.walls, self.flow_field.max_distance)
+            if self.fog is not None:
+                self.fog = FogOfWar(self.walls, self.tile_size, self.screen.get_size(), self.fog.fov.radius)
+            changed = grid.width * grid.height
+        else:
+            # Строки сравниваются целиком на стороне C, по клеткам идём только в отличающихся
+            for y in range(grid.height):
+                row = grid.row_slice(y, 0, grid.width)
+                if row == old.row_slice(y, 0, grid.width):
+                    continue
+                old_row = old.row_slice(y, 0, grid.width)
+                for x in range(grid.width):
+                    if row[x] != old_row[x]:
+                        tile = chr(row[x])
+                        self.tile_renderer.set_tile(x, y, tile)  # Перепекается только чанк клетки
+                        self.walls.set_wall(x, y, tile == '1')
+                        changed += 1
+            if changed:
+                if self.flow_field is not None:
+                    self.flow_field.target = None  # Пересчитать путь к игроку на следующем шаге
+                if self.fog is not None:
+                    self.fog.reset()
+
+        self.reconcile_spawns(spawns)
+        self.dirty = True
+        print(f"{self.watcher.path}: перезагружено, изменено клеток: {changed}")
+
+    def reconcile_spawns(self, spawns):
+        """Добавляет врагов и зелья с новых спавнов и убирает с исчезнувших; игрока не трогает"""
+        _, old_enemies, old_potions = self.spawns
+        _, new_enemies, new_potions = spawns
+
+        new_set = set(new_enemies)
+        for i, origin in enumerate(self.enemy_origins):
+            if origin not in new_set:
+                self.enemies.remove(i)  # Для уже убитых ничего не делает
+        for x, y in sorted(set(new_enemies) - set(old_enemies)):
+            self.enemy_origins.append((x, y))
+            self.enemies.add(x, y)
+
+        new_set = set(new_potions)
+        for i in range(len(self.potions) - 1, -1, -1):  # С конца: удаление переставляет последнее зелье
+            potion = self.potions[i]
+            if (potion.x // 40, potion.y // 40) not in new_set:
+                self.remove_potion(i)
+        for x, y in sorted(new_set - set(old_potions)):
+            self.potions.append(Potion(x, y))
+            self.potion_index.insert(len(self.potions) - 1, x * 40, y * 40)
+
+        self.spawns = (self.spawns[0], list(new_enemies), list(new_potions))
+
+    def level_hash(self):
+        """Отпечаток карты и спавнов: запись ввода подходит только к своему уровню"""
+        digest = hashlib.sha1()
+        if self.streaming:
+            start = self.map_data.grid_offset
+            digest.update(self.map_data.source[start:start + self.map_data.width * self.map_data.height])
+        else:
+            digest.update(self.map_data.cells)
+        digest.update(repr(self.spawns).encode())
+        return digest.digest()
+
+    def snapshot(self):
+        """Итог уровня в виде кортежа REPLAY_RESULT"""
+        enemies = self.enemies
+        # Пары x, y живых врагов подряд в int32, как в записях прежнего формата
+        positions = np.column_stack((enemies.xs, enemies.ys))[enemies.alive]
+        victory = -1 if self.victory is None else int(self.victory)
+        return (victory, self.clock.ticks, self.player.x, self.player.y, len(enemies), len(self.potions),
+                zlib.crc32(positions.tobytes()))
+
+    def handle_event(self, event):
+        """События сцены: игроку нужны только клавиши"""
+        if event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
+            self.handle_events(event)
 
     def handle_events(self, event):
         """Передает события игроку"""
+        if self.recorder is not None:
+            self.recorder.record(self.clock.ticks, event)
         self.player.handle_input(event)
 
     def update(self):
-        """Обновляет состояние уровня"""
+        """Кадр окна: догоняет реальное время фиксированными шагами и рисует"""
         if self.is_game_over:  # Если уровень завершён, прекращаем обновление
             return
+        if self.watcher is not None and self.watcher.changed():
+            self.reload_map()
+
+        now = time.perf_counter()
+        self.accumulator += min(now - self.last_frame_time, MAX_FRAME_TIME)
+        self.last_frame_time = now
+        while self.accumulator >= self.clock.dt:
+            self.step()
+            self.accumulator -= self.clock.dt
+            if self.is_game_over:
+                return
+
+        self.draw(self.accumulator / self.clock.dt)
+        profiler.mark("draw")
+        if self.dirty_renderer is not None:
+            self.dirty_renderer.present()
+        else:
+            profiler.draw(self.screen)
+            pygame.display.flip()
+        profiler.mark("flip")
+
+    def run_headless(self, max_ticks):
+        """Крутит симуляцию без отрисовки так быстро, как позволяет процессор"""
+        ticks = 0
+        while ticks < max_ticks and not self.is_game_over:
+            self.step()
+            ticks += 1
+        return ticks
+
+    def step(self):
+        """Один шаг симуляции"""
+        if self.is_game_over:
+            return
 
-        self.player.update(self.map_data)
-        self.camera.update(self.player)  # Камера следует за игроком
+        now = int(self.clock.now() * 1000)
+        self.player.update(self.walls, now)
+        if self.streaming:  # Камера следует за игроком, поэтому подкачиваем вокруг него
+            self.map_data.request_around(self.player.x // self.tile_size, self.player.y // self.tile_size)
+        profiler.mark("player")
+
+        if self.flow_field is not None:  # Клетка по центру спрайта игрока
+            self.flow_field.update((self.player.x + 17) // self.tile_size, (self.player.y + 17) // self.tile_size)
 
-        for enemy in self.enemies:
-            enemy.update(self.map_data)
+        # Враги в выгруженных чанках заморожены
+        self.enemies.update(self.walls, now, self.map_data.loaded_mask if self.streaming else None, self.flow_field)
+        profiler.mark("enemies")
 
-        # Проверяем столкновение игрока с зельями
-        for potion in self.potions:
-            if potion.check_collision(self.player):
-                self.potions.remove(potion)  # Убираем зелье из списка
+        # Проверяем столкновение игрока с зельями (зелье 40x40, игрок 35x35)
+        for i in sorted(self.potion_index.query(self.player.x - 40, self.player.y - 40,
+                                                self.player.x + 35, self.player.y + 35), reverse=True):
+            if self.potions[i].check_collision(self.player):
+                self.remove_potion(i)  # Убираем зелье из списка
                 self.player.activate_rage()  # Активируем состояние ярости
-                self.rage_start_time = time.time()  # Запоминаем время активации ярости
+                self.rage_start_time = self.clock.now()  # Запоминаем время активации ярости
 
         # Проверяем, истекло ли время ярости
-        if self.player.state_rage and time.time() - self.rage_start_time > 5:  # 5 секунд ярости
+        if self.player.state_rage and self.clock.now() - self.rage_start_time > 5:  # 5 секунд ярости
             self.player.deactivate_rage()  # Сбрасываем состояние ярости
 
         self.check_victory()  # Проверяем победу
         self.check_defeat()  # Проверяем поражение
+        profiler.mark("collisions")
 
-        self.draw()
-        pygame.display.flip()
+        self.clock.advance()
 
-    def draw(self):
-        """Отрисовка уровня с учетом камеры"""
-        self.screen.fill((0, 0, 0))
-        for y, row in enumerate(self.map_data):
-            for x, tile in enumerate(row):
-                texture = pygame.transform.scale(self.textures.get(tile, self.textures['0']), (40, 40))
-                screen_x, screen_y = self.camera.apply_tile(x, y, self.tile_size)
-                self.screen.blit(texture, (screen_x, screen_y))
+    def draw(self, alpha=1.0):
+        """Отрисовка уровня с учетом камеры; alpha — интерполяция между шагами"""
+        if self.headless:
+            return
 
-        self.player.draw(self.screen, self.camera)
+        self.camera.alpha = alpha
+        self.camera.update(self.player)  # Камера следует за игроком
+        if self.fog is not None:  # Видимость меняется только при переходе в другую клетку
+            tile_x = (self.player.x + 17) // self.tile_size
+            tile_y = (self.player.y + 17) // self.tile_size
+            if self.fog.update(tile_x, tile_y):
+                self.dirty = True
+        if self.dirty_renderer is not None:
+            self.dirty_renderer.render(self)
+            return
 
-        for enemy in self.enemies:
-            enemy.draw(self.screen, self.camera)  # Отрисовываем врагов
+        self.draw_background()
 
-        for potion in self.potions:
-            potion.draw(self.screen, self.camera)  # Отрисовываем зелья
+        self.sprites()  # Игрок, враги и зелья одной пачкой
+        self.sprite_batch.draw(self.screen)
+        self.draw_fog()
 
         if self.player.state_rage:
             self.draw_rage_timer()
 
         self.draw_timer()
 
+    def draw_background(self):
+        """Фон и тайлы под спрайтами"""
+        self.screen.fill((0, 0, 0))
+        self.tile_renderer.draw(self.screen, self.camera)
+
+    def draw_fog(self):
+        """Туман войны поверх спрайтов, под HUD"""
+        if self.fog is not None:
+            self.fog.draw(self.screen, self.camera)
+
+    def sprites(self):
+        """Собирает видимые спрайты кадра в порядке отрисовки: игрок, враги, зелья"""
+        camera = self.camera
+        batch = self.sprite_batch
+        batch.begin()
+        batch.add(*self.player.sprite(camera))
+        batch.extend(self.enemies.sprites(camera))
+        # Зелья неподвижны: видимые находит индекс, порядок — как в списке
+        left, top = camera.offset_x, camera.offset_y
+        for i in sorted(self.potion_index.query(left - 40, top - 40, left + camera.width, top + camera.height)):
+            batch.add(*self.potions[i].sprite(camera))
+        return batch.items
+
+    def hud(self):
+        """Строки HUD: (поверхность, rect)"""
+        items = [self.timer_item()]
+        if self.player.state_rage:
+            items.append(self.rage_timer_item())
+        return items
+
+    def timer_item(self):
+        """Таймер уровня"""
+        elapsed_time = int(self.clock.now() - self.start_time)
+        timer_text = self.timer_text.render(elapsed_time)
+        return timer_text, timer_text.get_rect(center=(self.screen.get_width() // 2, 20))
+
+    def rage_timer_item(self):
+        """Оставшееся время ярости"""
+        elapsed_time = int(self.clock.now() - self.rage_start_time)
+        remaining_time = max(5 - elapsed_time, 0)  # Оставшееся время, но не меньше 0
+        timer_text = self.rage_text.render(remaining_time)
+        return timer_text, timer_text.get_rect(center=(self.screen.get_width() // 2, 60))
+
     def draw_timer(self):
         """Отрисовка таймера"""
-        elapsed_time = int(time.time() - self.start_time)
-        font = pygame.font.Font("textures/font/Aladin-Regular.ttf", 36)
-        timer_text = font.render(f"Time: {elapsed_time}s", True, (255, 255, 255))
-        text_rect = timer_text.get_rect(center=(self.screen.get_width() // 2, 20))
-        self.screen.blit(timer_text, text_rect)
+        self.screen.blit(*self.timer_item())
 
     def draw_rage_timer(self):
         """Отрисовка таймера яроски игрока"""
-        elapsed_time = int(time.time() - self.rage_start_time)
-        remaining_time = max(5 - elapsed_time, 0)  # Оставшееся время, но не меньше 0
-
-        font = pygame.font.Font("textures/font/Aladin-Regular.ttf", 36)
-        timer_text = font.render(f"Time of rage: {remaining_time}s", True, (189, 0, 183))
-
-        text_rect = timer_text.get_rect(center=(self.screen.get_width() // 2, 60))
-        self.screen.blit(timer_text, text_rect)
+        self.screen.blit(*self.rage_timer_item())
+
+    def remove_potion(self, i):
+        """Удаляет зелье i за O(1): на его место переезжает последнее"""
+        last = len(self.potions) - 1
+        self.potion_index.remove(i)
+        if i != last:
+            moved = self.potions[last]
+            self.potions[i] = moved
+            self.potion_index.remove(last)
+            self.potion_index.insert(i, moved.x, moved.y)
+        self.potions.pop()
 
     def check_defeat(self):
         """Проверяет столкновение игрока с врагами"""
         player_rect = pygame.Rect(self.player.x, self.player.y, 30, 30)  # Хитбокс игрока
 
-        for enemy in self.enemies:
-            enemy_rect = pygame.Rect(enemy.x, enemy.y, 35, 35)  # Хитбокс врага
+        enemies = self.enemies
+        # Хитбокс врага 35x35: проверяем только тех, кто рядом с игроком
+        for i in enemies.near(self.player.x - 35, self.player.y - 35, self.player.x + 30, self.player.y + 30):
+            enemy_rect = pygame.Rect(enemies.xs[i], enemies.ys[i], 35, 35)  # Хитбокс врага
             if player_rect.colliderect(enemy_rect):  # Проверяем столкновение
                 if self.player.state_rage:
-                    self.enemies.remove(enemy)  # Удаляем врага, если игрок в состоянии ярости
+                    enemies.remove(i)  # Удаляем врага, если игрок в состоянии ярости
+                    self.kills += 1
                 else:
                     self.game_over(False)  # Вызываем проигрыш
                 return  # Выходим из метода после обработки столкновения
@@ -452,7 +2229,7 @@ class ShowLevel:
         player_tile_x = self.player.x // 40
         player_tile_y = self.player.y // 40
 
-        if self.map_data[player_tile_y][player_tile_x] == '2':  # Выход
+        if self.map_data.get(player_tile_x, player_tile_y) == '2':  # Выход
             self.game_over(True)  # Вызываем победу
 
     def game_over(self, victory):
@@ -461,108 +2238,140 @@ class ShowLevel:
             return
 
         self.is_game_over = True  # Устанавливаем флаг завершения уровня
-        self.screen.fill("BLACK")
-
-        if victory:
-            self.game.completed_levels.add(self.next_level)  # Добавляем уровень в пройденные
-            with open("data/progress.txt", "r") as file:
-                lines = file.readlines()
-
-            # Проверяем, есть ли уровень в файле
-            if self.next_level + "\n" not in lines:
-                with open("data/progress.txt", "a") as file:  # Открываем файл в режиме добавления
-                    file.write(self.next_level + "\n")  # Добавляем уровень в файл
-
+        self.victory = victory
         # Вычисляем время прохождения
-        elapsed_time = int(time.time() - self.start_time)
-
-        font = pygame.font.Font("textures/font/Aladin-Regular.ttf", 48)
-        message = "Victory!" if victory else "Defeat!"
-        text = font.render(message, True, (255, 0, 0))
-        text_rect = text.get_rect(center=(self.screen.get_width() // 2, self.screen.get_height() // 3))
-
-        time_font = pygame.font.Font("textures/font/Aladin-Regular.ttf", 42)
-        time_text = time_font.render(f"Time: {elapsed_time}", True, (255, 0, 0))
-        time_rect = time_text.get_rect(center=(self.screen.get_width() // 2, self.screen.get_height() // 2 - 50))
-
-        button_font = pygame.font.Font("textures/font/Aladin-Regular.ttf", 36)
-        button_text = button_font.render("OK", True, (255, 0, 0))
-        button_rect = pygame.Rect(self.screen.get_width() // 2 - 100, self.screen.get_height() // 2, 200, 100)
-
-        while True:
-            self.screen.fill("BLACK")
-            self.screen.blit(text, text_rect)
-            self.screen.blit(time_text, time_rect)
-            pygame.draw.rect(self.screen, (0, 0, 0), button_rect)
-            self.screen.blit(button_text, button_text.get_rect(center=button_rect.center))
-            pygame.display.flip()
+        self.elapsed_time = self.clock.now() - self.start_time
+        self.final_state = self.snapshot()
+        if self.recorder is not None:
+            self.recorder.save(self.record_path, self.final_state)
+        if self.game is None:  # Без окна и без игры только запоминаем итог
+            return
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    exit()
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    if button_rect.collidepoint(event.pos):
-                        self.game.current_screen = MainScreen(self.screen, self.game.completed_levels,
-                                                              self.game)  # Возвращаемся в меню
+        if victory:
+            # Сохранение только меняет память; на диск его допишет фоновый поток
+            self.game.save.complete_level(self.next_level)  # Добавляем уровень в пройденные
+            if self.name is not None:
+                self.game.save.record_time(self.name, self.elapsed_time)
 
-                        return  # Выход из экрана завершения
+        self.close()
+        self.game.replace_scene(ResultScreen(self.screen, self.game, victory, self.elapsed_time))
 
 
 class Game:
     def __init__(self):
         """Инициализация игры"""
+        started = time.perf_counter()
         pygame.init()
         self.screen = pygame.display.set_mode((800, 600))
         pygame.display.set_caption("The lost ghost")
         self.clock = pygame.time.Clock()
         self.running = True
+        self.preloader = LevelPreloader()
+        if PROFILE_CSV:
+            profiler.enabled = True
+            atexit.register(profiler.dump_csv, PROFILE_CSV)
         self.load_progress()
-        self.current_screen = MainScreen(self.screen, self.completed_levels, self)  # Передаём ссылку на Game
+        # Стек сцен: внизу меню, над ним уровень или экран итога
+        self.scenes = [MainScreen(self.screen, self.completed_levels, self)]  # Передаём ссылку на Game
+        self.startup_ms = (time.perf_counter() - started) * 1000
+        if VERBOSE:
+            print(f"Запуск: {self.startup_ms:.1f} мс, поверхности с диска: {assets.disk_hits}, "
+                  f"пересчитано: {assets.disk_misses}")
 
     def start_level(self, level_name):
         """Запуск уровня"""
-        if level_name == "Desert":
-            self.current_screen = ShowLevel(self.screen, DESERT_LEVEL_TEXTURES, DESERT_LEVEL_MAP, "Ocean", self)
-        elif level_name == "Ocean":
-            self.current_screen = ShowLevel(self.screen, OCEAN_LEVEL_TEXTURES, OCEAN_LEVEL_MAP, "Hell", self)
-        elif level_name == "Hell":
-            self.current_screen = ShowLevel(self.screen, HELL_LEVEL_TEXTURES, HELL_LEVEL_MAP, "Hell", self)
+        if level_name in LEVELS:
+            started = time.perf_counter()
+            level_data = self.preloader.take(level_name)
+            textures, map_file, next_level = LEVELS[level_name]
+            record_path = None
+            if RECORD_DIR:
+                os.makedirs(RECORD_DIR, exist_ok=True)
+                record_path = os.path.join(RECORD_DIR, f"{level_name}-{time.strftime('%Y%m%d-%H%M%S')}.rec")
+            self.push_scene(ShowLevel(self.screen, textures, map_file, next_level, self,
+                                      level_data=level_data, name=level_name, record_path=record_path,
+                                      hunters=HUNTERS))
+            if VERBOSE:
+                _, hit, wait_ms = self.preloader.report[-1]
+                print(f"{level_name}: {'готов заранее' if hit else 'промах предзагрузки'}, "
+                      f"ожидание {wait_ms:.1f} мс, старт {(time.perf_counter() - started) * 1000:.1f} мс")
 
     def load_progress(self):
         """Загрузка прогресса"""
-        try:
-            with open("data/progress.txt", "r") as file:
-                lines = file.readlines()
-                self.completed_levels = {line.strip() for line in lines}
-        except FileNotFoundError:
-            self.completed_levels = set()
+        self.save = SaveStore()
+        atexit.register(self.save.close)  # Дописываем сохранение при выходе
+        self.completed_levels = self.save.completed
+
+    @property
+    def current_screen(self):
+        """Активная сцена — верх стека"""
+        return self.scenes[-1]
+
+    def push_scene(self, scene):
+        """Открывает сцену поверх текущей"""
+        self.scenes.append(scene)
+
+    def replace_scene(self, scene):
+        """Заменяет верхнюю сцену (уровень сменяется экраном итога)"""
+        self.scenes[-1] = scene
+
+    def return_to_menu(self):
+        """Снимает со стека всё, кроме меню"""
+        del self.scenes[1:]
+        self.scenes[0].resume()
 
     def run(self):
         """Запуск игры"""
         while self.running:
+            scene = self.current_screen
+            profiler.begin_frame()
+            if scene.static:
+                # Статичный экран спит до события; таймаут нужен для фоновой предзагрузки
+                self.handle_event(pygame.event.wait(STATIC_WAIT_MS))
             self.handle_events()
+            profiler.mark("events")
             self.current_screen.update()
-            self.clock.tick(60)
+            profiler.end_frame()
+            if not scene.static:
+                self.clock.tick(60)  # Ограничение кадров нужно только игровым сценам
 
     def handle_events(self):
         """Обработка событий"""
         for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit()
-                sys.exit()
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                if isinstance(self.current_screen, MainScreen):
-                    self.current_screen.handle_click(*event.pos)
-            elif event.type == pygame.KEYDOWN or event.type == pygame.KEYUP:
-                if isinstance(self.current_screen, ShowLevel):
-                    self.current_screen.handle_events(event)
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        """Общие события игры, остальные — активной сцене"""
+        if event.type == pygame.NOEVENT:
+            return
+        if event.type == pygame.QUIT:
+            pygame.quit()
+            sys.exit()
+        elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            profiler.toggle()  # Оверлей профилировщика
+            self.current_screen.dirty = True
+        elif event.type in (pygame.WINDOWEXPOSED, pygame.WINDOWRESTORED, pygame.VIDEOEXPOSE):
+            self.current_screen.dirty = True  # Окно нужно нарисовать заново
+        else:
+            self.current_screen.handle_event(event)
 
     def quit(self):
         """Выход из игры"""
         pygame.quit()
 
 
+def create_headless_level(level_name, map_file=None, clock=None, streaming=False, seed=None, hunters=False,
+                          record_path=None):
+    """Создаёт уровень без окна (драйвер SDL dummy) для тестов, ботов и бенчмарков"""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    textures, default_map, next_level = LEVELS[level_name]
+    screen = pygame.Surface((800, 600))  # Нужен только размер для камеры
+    return ShowLevel(screen, textures, map_file or default_map, next_level, None, clock,
+                     headless=True, streaming=streaming, seed=seed, name=level_name, hunters=hunters,
+                     record_path=record_path)
+
+
 if __name__ == "__main__":
     game = Game()
     game.run()
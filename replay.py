@@ -0,0 +1,74 @@
+"""Воспроизведение записей ввода (.rec) без окна на максимальной скорости.
+
+Каждая запись прогоняется заново с тем же seed, итог сверяется с записанным.
+Запись включается переменной окружения GHOST_RECORD_DIR при обычной игре.
+
+Пример:
+    GHOST_RECORD_DIR=data/replays python main.py
+    python replay.py data/replays/*.rec
+    python replay.py --map maze.txt run.rec   # запись, сделанная на нестандартной карте
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")  # Приветствие pygame не должно попасть перед JSON с итогами
+
+import pygame
+
+import main
+
+RESULT_FIELDS = ("victory", "ticks", "player_x", "player_y", "enemies", "potions", "enemy_crc")
+
+
+def replay(path, map_file=None, max_ticks=None):
+    """Прогоняет запись и возвращает сравнение итогов и скорость в шагах в секунду"""
+    recording = main.read_recording(path)
+    expected = recording["result"]
+    level = main.create_headless_level(recording["level_name"], map_file, seed=recording["seed"],
+                                       hunters=bool(recording["flags"] & main.REPLAY_HUNTERS))
+    if level.level_hash() != recording["level_hash"]:
+        level.close()
+        return {"file": path, "ok": False, "error": "карта уровня не совпадает с записанной"}
+
+    # Запас шагов на случай расхождения, чтобы прогон не шёл бесконечно
+    limit = max_ticks if max_ticks is not None else expected[1] + main.TICK_RATE
+    events = recording["events"]
+    index = 0
+    start = time.perf_counter()
+    while not level.is_game_over and level.clock.ticks <= limit:
+        while index < len(events) and events[index][0] <= level.clock.ticks:
+            _, event_type, key = events[index]
+            level.handle_events(pygame.event.Event(event_type, key=key))
+            index += 1
+        level.step()
+    elapsed = time.perf_counter() - start
+    level.close()
+
+    actual = level.final_state or level.snapshot()
+    return {"file": path, "ok": tuple(actual) == tuple(expected),
+            "ticks": level.clock.ticks, "ticks_per_s": level.clock.ticks / elapsed if elapsed else 0.0,
+            "expected": dict(zip(RESULT_FIELDS, expected)), "actual": dict(zip(RESULT_FIELDS, actual))}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сверка записей ввода с повторным прогоном уровня")
+    parser.add_argument("recordings", nargs="+", help="файлы .rec")
+    parser.add_argument("--map", help="файл карты, если запись сделана не на стандартном уровне")
+    parser.add_argument("--max-ticks", type=int, help="предел шагов на одну запись")
+    return parser.parse_args(argv)
+
+
+def replay_main(argv=None):
+    args = parse_args(argv)
+    results = [replay(path, args.map, args.max_ticks) for path in args.recordings]
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(replay_main())